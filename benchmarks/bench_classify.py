@@ -0,0 +1,51 @@
+###############################3######
+# Check ismuon_array/isflasher_array against the per-entry cuts and time both
+# usage: python bench_classify.py [nevents]
+####################################333
+
+import os
+import sys
+import time
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import roottools
+
+def make_stats(nevents, seed=0):
+    '''Random CalibStats columns spread around the muon and flasher cuts.'''
+    rng = np.random.RandomState(seed)
+    columns = {
+        'MaxQ': rng.uniform(0, 0.6, nevents).astype('float32'),
+        'Quadrant': rng.uniform(0, 1.2, nevents).astype('float32'),
+        'time_PSD': rng.uniform(0.3, 1.2, nevents).astype('float32'),
+        'time_PSD1': rng.uniform(0.3, 1.2, nevents).astype('float32'),
+        'MaxQ_2inchPMT': rng.uniform(0, 200, nevents).astype('float32'),
+        'NominalCharge': rng.uniform(0, 6000, nevents).astype('float32'),
+    }
+    columns['NominalCharge'][::100] = 3000.0
+    return roottools.Batch(columns, np.arange(nevents))
+
+def label(entry):
+    if roottools.ismuon(entry):
+        return 3
+    elif roottools.isflasher(entry):
+        return 4
+    else:
+        return 5
+
+def main():
+    nevents = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    batch = make_stats(nevents)
+    # Per-entry cuts see python floats, like values read through an Entry.
+    rows = [dict((k, float(batch[k][i])) for k in batch.keys()) for i in xrange(nevents)]
+    t1 = time.time()
+    scalar = np.array([label(row) for row in rows])
+    t2 = time.time()
+    vector = np.where(roottools.ismuon_array(batch), 3,
+                      np.where(roottools.isflasher_array(batch), 4, 5))
+    t3 = time.time()
+    assert np.array_equal(scalar, vector), 'Labels differ for %d events' % np.sum(scalar != vector)
+    print "scalar %.3f s, array %.3f s for %i events (%.1fx), labels identical" % (
+        t2 - t1, t3 - t2, nevents, (t2 - t1) / (t3 - t2))
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,76 @@
+###############################3######
+# Time a batch pass and an entry pass over a synthetic recon file (see
+# fixtures.py) reading ROOT directly, filling the decoded column cache
+# (columncache.ColumnCache) and reading from the filled cache, as a later
+# job over the same file would. The cold entry pass already finds the
+# columns its batch pass stored.
+# usage: python bench_column_cache.py [nreadouts]
+####################################333
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'extract_all'))
+import roottools
+import columncache
+import convert_background
+import fixtures
+
+def readout_tree(rootfile, cache):
+    t = roottools.makeCalibReadoutTree(rootfile)
+    return roottools.RootTree(rootfile, t.treename, t.intbranches, t.floatbranches, t.ivectorbranches, t.fvectorbranches, cache=cache)
+
+def batch_pass(tree):
+    ''' The converter's reads: key columns for the join, then the readout branches in batches.'''
+    tree.read_columns(['triggerNumber', 'detector'])
+    return [tree.read_entries(np.arange(start, min(start + convert_background.BATCH_SIZE, tree.numEntries())),
+                              convert_background.READOUT_BRANCHES)
+            for start in xrange(0, tree.numEntries(), convert_background.BATCH_SIZE)]
+
+def entry_pass(tree):
+    ''' What test_extractAD-style loops do: every entry's charges.'''
+    return sum(float(tree.loadentry(i)['chargeAD'].sum()) for i in xrange(tree.numEntries()))
+
+def main():
+    nreadouts = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    tmpdir = tempfile.mkdtemp()
+    try:
+        rootfile = fixtures.recon_filename(tmpdir, 21221, 1)
+        fixtures.make_recon_file(rootfile, nreadouts)
+        cachedir = os.path.join(tmpdir, 'cache')
+        print "%d readouts" % nreadouts
+        print "%-22s %12s %12s" % ('reader', 'batches s', 'entries s')
+        results = {}
+        # every pass gets a new ColumnCache, so nothing stays mapped from the one before
+        for name, cache in [('ROOT', lambda: False),
+                            ('cache, cold', lambda: columncache.ColumnCache(cachedir, 1 << 40)),
+                            ('cache, warm', lambda: columncache.ColumnCache(cachedir, 1 << 40))]:
+            if name == 'cache, cold':
+                shutil.rmtree(cachedir, ignore_errors=True)
+            t1 = time.time()
+            batches = batch_pass(readout_tree(rootfile, cache()))
+            t2 = time.time()
+            total = entry_pass(readout_tree(rootfile, cache()))
+            t3 = time.time()
+            results[name] = (batches, total)
+            print "%-22s %12.3f %12.3f" % (name, t2 - t1, t3 - t2)
+        for name in ['cache, cold', 'cache, warm']:
+            batches, total = results[name]
+            assert np.isclose(total, results['ROOT'][1]), 'Entry pass differs'
+            for got, want in zip(batches, results['ROOT'][0]):
+                for branchname in convert_background.READOUT_BRANCHES:
+                    a, b = got[branchname], want[branchname]
+                    if isinstance(a, roottools.JaggedArray):
+                        assert np.array_equal(a.values, b.values) and np.array_equal(a.offsets, b.offsets), branchname
+                    else:
+                        assert np.array_equal(a, b), branchname
+        print "cache holds %.1f MB" % (sum(size for used, size, key, meta in columncache.ColumnCache(cachedir, 0).columns()) / 1e6)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,47 @@
+###############################3######
+# Check getChargesTimeBatch against getChargesTime and time both
+# usage: python bench_getchargestime.py [nevents]
+####################################333
+
+import os
+import sys
+import time
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import roottools
+
+def make_hits(nevents, seed=0):
+    '''Random jagged AD hits with plenty of duplicate PMT hits and a few
+    zero-charge hits, which exercise every branch of the duplicate rule.'''
+    rng = np.random.RandomState(seed)
+    counts = rng.randint(0, 250, nevents)
+    offsets = np.zeros(nevents + 1, dtype='int64')
+    np.cumsum(counts, out=offsets[1:])
+    nhits = offsets[-1]
+    charge = rng.exponential(5.0, nhits).astype('float32')
+    charge[rng.rand(nhits) < 0.01] = 0.0
+    columns = {
+        'nHitsAD': counts.astype('uint32'),
+        'chargeAD': roottools.JaggedArray(charge, offsets),
+        'timeAD': roottools.JaggedArray(rng.uniform(-1800, -1100, nhits).astype('float32'), offsets),
+        'ring': roottools.JaggedArray(rng.randint(1, 9, nhits).astype('int32'), offsets),
+        'column': roottools.JaggedArray(rng.randint(1, 25, nhits).astype('int32'), offsets),
+    }
+    return roottools.Batch(columns, np.arange(nevents))
+
+def main():
+    nevents = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    batch = make_hits(nevents)
+    for dtype in ['float32', 'float64']:
+        t1 = time.time()
+        scalar = [roottools.getChargesTime(batch.row(i), preprocess_flag=True, dtype=dtype) for i in xrange(nevents)]
+        t2 = time.time()
+        charge, time_ = roottools.getChargesTimeBatch(batch, preprocess_flag=True, dtype=dtype)
+        t3 = time.time()
+        for i, (c, t) in enumerate(scalar):
+            assert np.array_equal(c, charge[i]) and np.array_equal(t, time_[i]), 'Mismatch in event %d' % i
+        print "%s: scalar %.3f s, batch %.3f s for %i events (%.1fx), outputs identical" % (
+            dtype, t2 - t1, t3 - t2, nevents, (t2 - t1) / (t3 - t2))
+
+if __name__=='__main__':
+    main()
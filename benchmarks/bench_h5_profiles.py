@@ -0,0 +1,66 @@
+###############################3######
+# Compare the h5tools output profiles on a synthetic 8x24 dataset:
+# file size, write time and random minibatch read time.
+# usage: python bench_h5_profiles.py [nevents] [minibatch]
+####################################333
+
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import h5py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import h5tools
+
+NFEATURES = 192
+
+def make_images(nevents, seed=0):
+    '''Charge and time images with the sparsity and ranges of AD readouts.'''
+    rng = np.random.RandomState(seed)
+    hit = rng.rand(nevents, NFEATURES) < 0.6
+    charge = np.where(hit, rng.exponential(3.0, (nevents, NFEATURES)), 0.0)
+    time_ = np.where(hit, rng.normal(-1450, 60, (nevents, NFEATURES)), 0.0)
+    return charge, time_
+
+def write(filename, charge, time_, profile):
+    columns = {'charge': ((NFEATURES,), 'float64'), 'time': ((NFEATURES,), 'float64')}
+    h5f = h5py.File(filename, 'w')
+    writer = h5tools.H5StreamWriter(h5f, columns, expected_rows=len(charge), profile=profile)
+    for start in xrange(0, len(charge), 10000):
+        writer.append({'charge': charge[start:start+10000], 'time': time_[start:start+10000]})
+    writer.close()
+    h5f.close()
+
+def read_minibatches(filename, minibatch, nbatches, seed=0):
+    '''Read contiguous minibatches at random offsets, as a shuffled-batch trainer does.'''
+    rng = np.random.RandomState(seed)
+    h5f = h5py.File(filename, 'r')
+    charge = h5f['charge']
+    time_ = h5f['time']
+    starts = rng.randint(0, len(charge) - minibatch, nbatches)
+    for start in starts:
+        charge[start:start+minibatch]
+        time_[start:start+minibatch]
+    h5f.close()
+
+def main():
+    nevents = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    minibatch = int(sys.argv[2]) if len(sys.argv) > 2 else h5tools.DEFAULT_CHUNK_ROWS
+    charge, time_ = make_images(nevents)
+    tmpdir = tempfile.mkdtemp()
+    print "%-14s %10s %10s %14s" % ('profile', 'size (MB)', 'write (s)', 'read/batch (ms)')
+    for name in sorted(h5tools.PROFILES):
+        filename = os.path.join(tmpdir, name + '.h5')
+        t1 = time.time()
+        write(filename, charge, time_, h5tools.PROFILES[name])
+        t2 = time.time()
+        nbatches = 200
+        read_minibatches(filename, minibatch, nbatches)
+        t3 = time.time()
+        print "%-14s %10.1f %10.2f %14.2f" % (name, os.path.getsize(filename) / 1e6, t2 - t1, 1000 * (t3 - t2) / nbatches)
+        os.remove(filename)
+    os.rmdir(tmpdir)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,67 @@
+###############################3######
+# Time how long an MPI job takes to give every rank the IBD candidate
+# table and the file list: every rank reading them, or rank 0 reading
+# them and broadcasting or sharing them per node (mpitools).
+# usage: mpiexec -n 32 python bench_mpi_tables.py [ncandidates] [nfiles]
+####################################333
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import numpy as np
+from mpi4py import MPI
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'extract_all'))
+import ibdtools
+import mpitools
+import convert_background
+import bench_startup
+
+def every_rank_reads(comm, candidates, filelist, cache):
+    index = ibdtools.load_ibd_index(candidates, cache=cache)
+    content = convert_background.load_file_list(filelist)
+    return index, content
+
+def rank0_reads(comm, candidates, filelist, share):
+    table = content = None
+    if comm.Get_rank() == 0:
+        table = ibdtools.load_ibd_index(candidates).table()
+        content = convert_background.load_file_list(filelist)
+    return ibdtools.IBDIndex.from_table(share(comm, table)), share(comm, content)
+
+def main():
+    comm = MPI.COMM_WORLD
+    ncandidates = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+    nfiles = int(sys.argv[2]) if len(sys.argv) > 2 else 2500
+    tmpdir = comm.bcast(tempfile.mkdtemp() if comm.Get_rank() == 0 else None, root=0)
+    if comm.Get_rank() == 0:
+        candidates, filelist = bench_startup.make_inputs(tmpdir, ncandidates, nfiles)
+        # warm the candidate cache so the sharing rows measure the cached load on rank 0
+        every_rank_reads(comm, candidates, filelist, True)
+    candidates, filelist = comm.bcast((candidates, filelist) if comm.Get_rank() == 0 else None, root=0)
+    rows = [('every rank parses text', lambda: every_rank_reads(comm, candidates, filelist, False), comm.Get_size()),
+            ('every rank maps cache', lambda: every_rank_reads(comm, candidates, filelist, True), comm.Get_size()),
+            ('rank 0 + bcast_array', lambda: rank0_reads(comm, candidates, filelist, mpitools.bcast_array), 1),
+            ('rank 0 + shared_array', lambda: rank0_reads(comm, candidates, filelist, mpitools.shared_array), 1)]
+    reference = None
+    if comm.Get_rank() == 0:
+        print "%d ranks, %d candidates, %d files" % (comm.Get_size(), ncandidates, nfiles)
+        print "%-24s %12s %14s" % ('method', 'max ms', 'readers/table')
+    for name, func, readers in rows:
+        comm.Barrier()
+        t1 = time.time()
+        index, content = func()
+        elapsed = comm.reduce(time.time() - t1, op=MPI.MAX, root=0)
+        if reference is None:
+            reference = (np.array(index.table()), list(content))
+        assert np.array_equal(index.table(), reference[0]) and list(content) == reference[1], name
+        if comm.Get_rank() == 0:
+            print "%-24s %12.1f %14d" % (name, 1000 * elapsed, readers)
+    comm.Barrier()
+    if comm.Get_rank() == 0:
+        shutil.rmtree(tmpdir)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,74 @@
+###############################3######
+# Time what a converter task does before its first file: module imports
+# and loading the IBD candidate table, from text and from its memory-mapped
+# .npy cache, and the file list. Every measurement runs in a fresh python.
+# usage: python bench_startup.py [ncandidates] [nfiles] [repeat]
+####################################333
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PATH = [os.path.join(HERE, '..'), os.path.join(HERE, '..', 'extract_all')]
+
+def time_in_fresh_python(setup, stmt, repeat):
+    '''Median seconds of stmt after setup, each time in a new interpreter.'''
+    code = 'import sys, time; sys.path[:0] = %r\n%s\nt = time.time()\n%s\nprint time.time() - t' % (PATH, setup, stmt)
+    times = []
+    for i in xrange(repeat):
+        with open(os.devnull, 'w') as devnull:
+            out = subprocess.check_output([sys.executable, '-c', code], stderr=devnull)
+        times.append(float(out.split()[-1]))
+    return np.median(times)
+
+def make_inputs(tmpdir, ncandidates, nfiles, seed=0):
+    rng = np.random.RandomState(seed)
+    candidates = os.path.join(tmpdir, 'ibd_candidates.txt')
+    with open(candidates, 'w') as f:
+        f.write('RunNo\tFileNo\tDetector\ttrigno_prompt\ttrigno_delayed\n')
+        runs = rng.randint(21000, 68000, ncandidates)
+        files = rng.randint(1, 40, ncandidates)
+        prompt = rng.randint(0, 10**7, ncandidates)
+        for row in zip(runs, files, rng.randint(1, 5, ncandidates), prompt, prompt + rng.randint(1, 20, ncandidates)):
+            f.write('%d\t%d\t%d\t%d\t%d\n' % row)
+    filelist = os.path.join(tmpdir, 'filelist')
+    with open(filelist, 'w') as f:
+        for i in xrange(nfiles):
+            f.write('/global/project/projectdirs/dayabay/data/exp/dayabay/2012/p14a/Neutrino/0101/'
+                    'recon.Neutrino.%07d.Physics.EH1-Merged.P14A-P._%04d.root\n' % (21000 + i // 30, i % 30 + 1))
+    return candidates, filelist
+
+def main():
+    ncandidates = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+    nfiles = int(sys.argv[2]) if len(sys.argv) > 2 else 2500
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    tmpdir = tempfile.mkdtemp()
+    try:
+        candidates, filelist = make_inputs(tmpdir, ncandidates, nfiles)
+        rows = []
+        for module in ['numpy', 'h5py', 'pandas', 'mpi4py.MPI', 'roottools', 'ibdtools', 'convert_background']:
+            rows.append(('import ' + module, '', 'import ' + module))
+        load_index = "ibdtools.load_ibd_index(%r, cache=%s).lookup(21221, 1)"
+        rows.append(('candidates, text', 'import ibdtools', load_index % (candidates, False)))
+        time_in_fresh_python('import ibdtools', load_index % (candidates, True), 1) # Writes the cache.
+        rows.append(('candidates, cached', 'import ibdtools', load_index % (candidates, True)))
+        load_list = "convert_background.load_file_list(%r)[%d]"
+        rows.append(('file list', 'import convert_background', load_list % (filelist, nfiles - 1)))
+        print "%d candidates, %d files, median of %d fresh interpreters" % (ncandidates, nfiles, repeat)
+        print "%-26s %10s" % ('step', 'ms')
+        for name, setup, stmt in rows:
+            try:
+                seconds = time_in_fresh_python(setup, stmt, repeat)
+            except subprocess.CalledProcessError:
+                print "%-26s %10s" % (name, 'n/a')
+                continue
+            print "%-26s %10.1f" % (name, 1000 * seconds)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,133 @@
+###############################3######
+# Time the roottools and converter stages on synthetic recon files of
+# several sizes (see fixtures.py), so changes can be measured off Cori.
+# usage: python bench_suite.py [--sizes 1000 10000 50000] [--json out.json] [--compare old.json]
+####################################333
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import contextlib
+import numpy as np
+import h5py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'extract_all'))
+import roottools
+import ibdtools
+import h5tools
+import convert_background
+import fixtures
+
+@contextlib.contextmanager
+def quiet():
+    ''' Silence the progress prints of the code under test.'''
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def timed(results, name, func):
+    t1 = time.time()
+    with quiet():
+        out = func()
+    results[name] = time.time() - t1
+    return out
+
+def run_size(nreadouts, tmpdir):
+    ''' Return {benchmark: seconds} for one synthetic recon file of nreadouts readouts.'''
+    results = {}
+    run_no, file_no = 21221, 1
+    rootfile = fixtures.recon_filename(tmpdir, run_no, file_no)
+    pairs = timed(results, 'fixture', lambda: fixtures.make_recon_file(rootfile, nreadouts))
+    candfile = os.path.join(tmpdir, 'ibd_candidates.txt')
+    fixtures.write_candidates(candfile, run_no, file_no, pairs)
+    ibd_index = ibdtools.load_ibd_index(candfile)
+
+    readout_tree = roottools.makeCalibReadoutTree(rootfile)
+    stats_tree = roottools.makeCalibStatsTree(rootfile)
+    timed(results, 'getentries', lambda: sum(1 for entry in readout_tree.getentries()))
+    timed(results, 'iter_batches', lambda: sum(len(b) for b in readout_tree.iter_batches(
+        convert_background.BATCH_SIZE, convert_background.READOUT_BRANCHES)))
+    readout_entries, stats_entries = timed(results, 'join', lambda: roottools.joinCalibTrees(readout_tree, stats_tree))
+    batch = roottools.Batch.concatenate(roottools.iterJoinedBatches(
+        readout_tree, stats_tree, readout_entries, stats_entries,
+        convert_background.READOUT_BRANCHES, convert_background.STATS_BRANCHES, convert_background.BATCH_SIZE))
+    n = len(batch)
+
+    scalar = timed(results, 'getChargesTime', lambda: [roottools.getChargesTime(batch.row(i), False, 'float64') for i in xrange(n)])
+    charge, time_ = timed(results, 'getChargesTimeBatch', lambda: roottools.getChargesTimeBatch(batch, False, 'float64'))
+    for i, (c, t) in enumerate(scalar):
+        assert np.array_equal(c, charge[i]) and np.array_equal(t, time_[i]), 'Image mismatch in event %d' % i
+
+    labels = timed(results, 'get_class', lambda: [convert_background.get_class(ibd_index, batch.row(i), file_no, run_no) for i in xrange(n)])
+    classes = timed(results, 'get_class_array', lambda: convert_background.get_class_array(ibd_index, batch, file_no, run_no))
+    assert np.array_equal(labels, classes), 'Class mismatch'
+
+    def write():
+        h5f = h5py.File(os.path.join(tmpdir, 'write.h5'), 'w')
+        writer = h5tools.H5StreamWriter(h5f, convert_background.OUTPUT_COLUMNS, expected_rows=n)
+        for start in xrange(0, n, convert_background.BATCH_SIZE):
+            stop = min(start + convert_background.BATCH_SIZE, n)
+            writer.append({'charge': charge[start:stop].reshape((stop - start, -1)),
+                           'time': time_[start:stop].reshape((stop - start, -1)),
+                           'class': classes[start:stop],
+                           'trig_no': batch['triggerNumber'][start:stop],
+                           'detector_no': batch['detector'][start:stop],
+                           'run_no': np.repeat(run_no, stop - start),
+                           'file_no': np.repeat(file_no, stop - start),
+                           'eh': np.repeat(1, stop - start)})
+        writer.close()
+        h5f.close()
+    timed(results, 'h5_write', write)
+
+    h5_path = os.path.join(tmpdir, convert_background.get_h5_filename(rootfile))
+    timed(results, 'convert_file', lambda: convert_background.convert_file(rootfile, h5_path, ibd_index, h5tools.PROFILES['float64']))
+    timed(results, 'convert_pipeline', lambda: convert_background.convert_file(rootfile, h5_path, ibd_index, h5tools.PROFILES['float64'],
+                                                                               pipeline_depth=2))
+    results['events'] = n
+    results['readouts'] = nreadouts
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark roottools and the converter on synthetic files.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000], help='Readouts per synthetic file')
+    parser.add_argument('--json', help='Write the timings to this file')
+    parser.add_argument('--compare', help='Timings file of an earlier run to compare against')
+    args = parser.parse_args()
+    old = None
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+    report = {}
+    for nreadouts in args.sizes:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            results = run_size(nreadouts, tmpdir)
+        finally:
+            shutil.rmtree(tmpdir)
+        report[str(nreadouts)] = results
+        n = results['events']
+        print "%d readouts, %d AD events after the join" % (nreadouts, n)
+        # the first four stages go over every readout, the rest over the joined AD events
+        print "  %-20s %10s %12s %10s" % ('benchmark', 'seconds', 'events/s', 'vs old')
+        for name in ['fixture', 'getentries', 'iter_batches', 'join', 'getChargesTime', 'getChargesTimeBatch',
+                     'get_class', 'get_class_array', 'h5_write', 'convert_file', 'convert_pipeline']:
+            seconds = results[name]
+            change = ''
+            if old is not None and str(nreadouts) in old and name in old[str(nreadouts)]:
+                change = '%.2fx' % (old[str(nreadouts)][name] / max(seconds, 1e-9))
+            events = nreadouts if name in ('fixture', 'getentries', 'iter_batches', 'join') else n
+            print "  %-20s %10.3f %12.0f %10s" % (name, seconds, events / max(seconds, 1e-9), change)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,68 @@
+###############################3######
+# Time turning the std::vector branches of one AD event into numpy arrays:
+# copying element by element through PyROOT (the old Entry path) against
+# one copy of the vector's buffer (roottools.vector_view + copy, what an
+# Entry hands out now). The bare view is shown for reference; it is only
+# valid until the next entry is loaded. Needs PyROOT.
+# usage: python bench_vector_view.py [nhits] [repeat]
+####################################333
+
+import os
+import sys
+import time
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import roottools
+
+def per_call(func, repeat):
+    ''' Best of 3 mean seconds per call over repeat calls.'''
+    best = None
+    for k in xrange(3):
+        t1 = time.time()
+        for i in xrange(repeat):
+            func()
+        elapsed = (time.time() - t1) / repeat
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    nhits = int(sys.argv[1]) if len(sys.argv) > 1 else 200 # Hits of a typical AD readout.
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    try:
+        import ROOT
+    except ImportError:
+        print "PyROOT is not available; this benchmark measures PyROOT std::vector access."
+        return
+    rng = np.random.RandomState(0)
+    vectors = {}
+    for name, typ, values in [('chargeAD', 'float', rng.uniform(0, 100, nhits)),
+                              ('timeAD', 'float', rng.uniform(-1700, -1200, nhits)),
+                              ('ring', 'int', rng.randint(1, 9, nhits)),
+                              ('column', 'int', rng.randint(1, 25, nhits))]:
+        vec = ROOT.std.vector(typ)()
+        for v in values:
+            vec.push_back(v)
+        vectors[name] = (vec, 'float32' if typ == 'float' else 'int32')
+    if roottools.vector_view(vectors['chargeAD'][0], 'float32') is None:
+        print "This PyROOT gives no std::vector buffer; Entry falls back to copying."
+        return
+
+    def old():
+        # what Entry did before: float32 copies and int64 ring/column
+        return [np.array(vec, dtype='float32' if dtype == 'float32' else 'int') for vec, dtype in vectors.itervalues()]
+    def view():
+        return [roottools.vector_view(vec, dtype) for vec, dtype in vectors.itervalues()]
+    def view_copy():
+        return [roottools.vector_view(vec, dtype).copy() for vec, dtype in vectors.itervalues()]
+    for got, want in zip(view(), old()):
+        assert np.array_equal(got, want), 'View differs from the copied values'
+
+    print "%d hits per vector, 4 vectors per event" % nhits
+    print "%-28s %12s %10s" % ('method', 'us/event', 'speedup')
+    base = per_call(old, repeat)
+    for name, func in [('np.array over PyROOT', old), ('vector_view + copy (Entry)', view_copy), ('vector_view alone', view)]:
+        seconds = per_call(func, repeat)
+        print "%-28s %12.2f %9.1fx" % (name, 1e6 * seconds, base / seconds)
+
+if __name__=='__main__':
+    main()
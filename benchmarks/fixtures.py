@@ -0,0 +1,241 @@
+###############################3######
+# Synthetic Daya Bay ROOT files for benchmarks and local checks.
+# Writes recon files with the CalibReadout and CalibStats trees read by
+# roottools.makeCalibReadoutTree/makeCalibStatsTree, and IBD pair files
+# with the tr_ibd tree read by extract_ibd_from_yasu.py. ROOT is only
+# imported to write the files; simulate_recon and simulate_ibd need numpy.
+# usage: python fixtures.py <directory> [nreadouts] [npairs]
+####################################333
+
+import os
+import sys
+import array
+import numpy as np
+
+NPMTS = 192
+AD_DETECTORS = [1, 2] # EH1; detectors 5 and 6 are the water pools.
+POOL_FRACTION = 0.3 # Share of readouts from the water pools, which have no AD hits.
+MUON_FRACTION = 0.08 # Share of AD readouts above the muon charge cut.
+FLASHER_FRACTION = 0.03 # Share of AD readouts that fail the flasher cut.
+
+READOUT_TREE = '/Event/CalibReadout/CalibReadoutHeader'
+STATS_TREE = '/Event/Data/CalibStats'
+# Same branch lists as roottools.makeCalibReadoutTree and makeCalibStatsTree.
+READOUT_BRANCHES = (['nHitsAD', 'triggerNumber', 'detector'], [],
+                    ['ring', 'column', 'wallNumber'],
+                    ['timeAD', 'chargeAD', 'timePool', 'chargePool', 'wallSpot'])
+STATS_BRANCHES = (['triggerNumber'],
+                  ['MaxQ', 'Quadrant', 'time_PSD', 'time_PSD1', 'MaxQ_2inchPMT', 'NominalCharge'],
+                  [], [])
+IBD_TREE = 'tr_ibd'
+IBD_INTBRANCHES = ['runno', 'fileno', 'site', 'det', 'time_sec',
+    'time_nanosec', 'trigno_prompt', 'trigno_delayed',
+    'nHitsAD_prompt', 'nHitsAD_delayed']
+IBD_FLOATBRANCHES = ['dt_last_ad_muon', 'dt_last_ad_shower_muon',
+    'dt_last_wp_muon']
+
+def recon_filename(directory, run_no, file_no, site=1):
+    ''' Production style name, so the converters can parse run, file and hall.'''
+    return os.path.join(directory, 'recon.Neutrino.%07d.Physics.EH%d-Merged.P14A-P._%04d.root' % (run_no, site, file_no))
+
+def ad_hits(rng, kind):
+    '''
+    One AD readout: (ring, column, time, charge) arrays of its hits. Most
+    PMTs fire once inside the trigger window; some fire again later
+    (afterpulses) and a few dark-noise hits land anywhere in the readout.
+    '''
+    if kind == 'muon':
+        pmts = np.arange(NPMTS)
+        npe = rng.uniform(50, 500, NPMTS)
+    elif kind == 'flasher':
+        # one bright PMT plus a dim ring of light around the detector
+        pmts = np.sort(rng.choice(NPMTS, rng.randint(120, NPMTS), replace=False))
+        npe = rng.exponential(2.0, len(pmts))
+        npe[rng.randint(len(pmts))] = rng.uniform(500, 2000)
+    else:
+        energy = rng.exponential(1.5) + 0.2 # MeV, roughly the falling trigger spectrum
+        npmts = min(NPMTS, rng.poisson(25 * energy) + 3)
+        pmts = np.sort(rng.choice(NPMTS, npmts, replace=False))
+        npe = rng.exponential(1.5 * energy, npmts) + 0.2
+    charge = rng.normal(npe, np.sqrt(npe) * 0.3).clip(0.05)
+    time_ = rng.normal(-1450, 20, len(pmts))
+    # afterpulses, outside the window the converter keeps
+    after = rng.rand(len(pmts)) < (0.5 if kind == 'muon' else 0.1)
+    pmts = np.concatenate([pmts, pmts[after]])
+    charge = np.concatenate([charge, rng.exponential(1.0, after.sum())])
+    time_ = np.concatenate([time_, rng.uniform(-1240, -1000, after.sum())])
+    ndark = rng.poisson(3)
+    pmts = np.concatenate([pmts, rng.randint(0, NPMTS, ndark)])
+    charge = np.concatenate([charge, rng.exponential(1.0, ndark)])
+    time_ = np.concatenate([time_, rng.uniform(-1800, -1000, ndark)])
+    order = rng.permutation(len(pmts))
+    pmts = pmts[order]
+    return (pmts // 24 + 1).astype('int32'), (pmts % 24 + 1).astype('int32'), time_[order].astype('float32'), charge[order].astype('float32')
+
+def ad_stats(rng, kind, charge):
+    ''' CalibStats variables consistent with roottools.ismuon and isflasher for this kind.'''
+    if kind == 'flasher':
+        return {'MaxQ': rng.uniform(0.5, 1.0), 'Quadrant': rng.uniform(0.5, 1.5),
+                'time_PSD': rng.uniform(0.5, 0.9), 'time_PSD1': rng.uniform(0.5, 0.9),
+                'MaxQ_2inchPMT': rng.uniform(0, 300), 'NominalCharge': min(charge.sum(), 3000.)}
+    stats = {'MaxQ': rng.uniform(0.02, 0.25), 'Quadrant': rng.uniform(0.0, 0.6),
+             'time_PSD': rng.uniform(0.8, 1.0), 'time_PSD1': rng.uniform(0.8, 1.0),
+             'MaxQ_2inchPMT': rng.uniform(0, 50), 'NominalCharge': charge.sum()}
+    if kind == 'muon':
+        stats['NominalCharge'] = max(stats['NominalCharge'], 3000.5)
+    return stats
+
+def simulate_recon(nreadouts, seed=0):
+    '''
+    Return (readout rows, stats rows, ibd pairs) of one synthetic recon
+    file. Rows are dicts of branch values; trigger numbers count up over
+    all detectors and CalibStats has one row per readout, in the same
+    order. ibd pairs are (detector, prompt, delayed) trigger numbers of
+    consecutive 'other' readouts of one AD.
+    '''
+    rng = np.random.RandomState(seed)
+    readouts = []
+    stats = []
+    last_other = {}
+    pairs = []
+    for i in xrange(nreadouts):
+        if rng.rand() < POOL_FRACTION:
+            detector = int(rng.choice([5, 6]))
+            kind = 'pool'
+        else:
+            detector = int(rng.choice(AD_DETECTORS))
+            u = rng.rand()
+            kind = 'muon' if u < MUON_FRACTION else 'flasher' if u < MUON_FRACTION + FLASHER_FRACTION else 'other'
+        tn = i + 1
+        if kind == 'pool':
+            ring = column = np.zeros(0, dtype='int32')
+            time_ = charge = np.zeros(0, dtype='float32')
+            npool = rng.randint(10, 150)
+            pool = {'wallNumber': rng.randint(1, 9, npool).astype('int32'),
+                    'timePool': rng.normal(-1450, 30, npool).astype('float32'),
+                    'chargePool': rng.exponential(3.0, npool).astype('float32'),
+                    'wallSpot': rng.randint(1, 100, npool).astype('float32')}
+        else:
+            ring, column, time_, charge = ad_hits(rng, kind)
+            pool = {'wallNumber': np.zeros(0, dtype='int32'), 'timePool': np.zeros(0, dtype='float32'),
+                    'chargePool': np.zeros(0, dtype='float32'), 'wallSpot': np.zeros(0, dtype='float32')}
+            if kind == 'other':
+                if detector in last_other and rng.rand() < 0.02:
+                    # a delayed event is never the prompt of the next pair
+                    pairs.append((detector, last_other.pop(detector), tn))
+                else:
+                    last_other[detector] = tn
+        row = {'triggerNumber': tn, 'detector': detector, 'nHitsAD': len(ring),
+               'ring': ring, 'column': column, 'timeAD': time_, 'chargeAD': charge}
+        row.update(pool)
+        readouts.append(row)
+        stat = ad_stats(rng, kind, charge) if kind != 'pool' else ad_stats(rng, 'other', charge)
+        stat['triggerNumber'] = tn
+        stats.append(stat)
+    return readouts, stats, pairs
+
+def simulate_ibd(npairs, seed=0, run_no=21221, file_no=1):
+    ''' Rows of the tr_ibd tree: prompt and delayed AD hits plus metadata.'''
+    rng = np.random.RandomState(seed)
+    rows = []
+    tn = 0
+    for i in xrange(npairs):
+        tn += rng.randint(10, 5000)
+        row = {'runno': run_no, 'fileno': file_no, 'site': 1, 'det': int(rng.choice(AD_DETECTORS)),
+               'time_sec': 1300000000 + i, 'time_nanosec': rng.randint(0, 10**9),
+               'trigno_prompt': tn, 'trigno_delayed': tn + rng.randint(1, 5),
+               'dt_last_ad_muon': rng.exponential(1e-2), 'dt_last_ad_shower_muon': rng.exponential(1.0),
+               'dt_last_wp_muon': rng.exponential(1e-2)}
+        for suffix in ('_prompt', '_delayed'):
+            ring, column, time_, charge = ad_hits(rng, 'other')
+            row['nHitsAD' + suffix] = len(ring)
+            row['hitCountAD' + suffix] = np.ones(len(ring), dtype='int32')
+            row['ring' + suffix] = ring
+            row['column' + suffix] = column
+            row['timeAD' + suffix] = time_
+            row['chargeAD' + suffix] = charge
+        rows.append(row)
+    return rows
+
+def write_tree(directory, name, rows, intbranches=[], floatbranches=[], ivectorbranches=[], fvectorbranches=[]):
+    '''
+    Fill a TTree in directory with one entry per row. Scalars are written
+    as UInt_t and Float_t leaves and vectors as std::vector branches, the
+    types RootTree binds them to.
+    '''
+    import ROOT
+    directory.cd()
+    tree = ROOT.TTree(name, name)
+    ptrs = {}
+    for branchname in intbranches:
+        ptrs[branchname] = array.array('I', [0])
+        tree.Branch(branchname, ptrs[branchname], branchname + '/i')
+    for branchname in floatbranches:
+        ptrs[branchname] = array.array('f', [0])
+        tree.Branch(branchname, ptrs[branchname], branchname + '/F')
+    for branchname in ivectorbranches:
+        ptrs[branchname] = ROOT.std.vector('int')()
+        tree.Branch(branchname, ptrs[branchname])
+    for branchname in fvectorbranches:
+        ptrs[branchname] = ROOT.std.vector('float')()
+        tree.Branch(branchname, ptrs[branchname])
+    vectors = ivectorbranches + fvectorbranches
+    for row in rows:
+        for branchname in intbranches + floatbranches:
+            ptrs[branchname][0] = row[branchname]
+        for branchname in vectors:
+            vec = ptrs[branchname]
+            vec.clear()
+            for x in row[branchname]:
+                vec.push_back(x)
+        tree.Fill()
+    tree.Write()
+
+def make_recon_file(filename, nreadouts, seed=0):
+    '''
+    Write a recon file with the CalibReadout and CalibStats trees. Returns
+    the IBD pairs as (detector, prompt, delayed) trigger numbers.
+    '''
+    import ROOT
+    readouts, stats, pairs = simulate_recon(nreadouts, seed)
+    f = ROOT.TFile(filename, 'RECREATE')
+    event = f.mkdir('Event')
+    for treepath, rows, branches in [(READOUT_TREE, readouts, READOUT_BRANCHES), (STATS_TREE, stats, STATS_BRANCHES)]:
+        dirname, treename = treepath.strip('/').split('/')[1:]
+        write_tree(event.mkdir(dirname), treename, rows, *branches)
+    f.Close()
+    return pairs
+
+def make_ibd_file(filename, npairs, seed=0, run_no=21221, file_no=1):
+    ''' Write an IBD pair file with the tr_ibd tree.'''
+    import ROOT
+    rows = simulate_ibd(npairs, seed, run_no, file_no)
+    f = ROOT.TFile(filename, 'RECREATE')
+    write_tree(f, IBD_TREE, rows, IBD_INTBRANCHES, IBD_FLOATBRANCHES,
+               ['hitCountAD_prompt', 'ring_prompt', 'column_prompt',
+                'hitCountAD_delayed', 'ring_delayed', 'column_delayed'],
+               ['timeAD_prompt', 'chargeAD_prompt', 'timeAD_delayed', 'chargeAD_delayed'])
+    f.Close()
+
+def write_candidates(filename, run_no, file_no, pairs):
+    ''' Tab separated candidate list in the format of ibd_candidates_eh1.txt.'''
+    with open(filename, 'w') as f:
+        f.write('RunNo\tFileNo\tDetector\ttrigno_prompt\ttrigno_delayed\n')
+        for detector, prompt, delayed in pairs:
+            f.write('%d\t%d\t%d\t%d\t%d\n' % (run_no, file_no, detector, prompt, delayed))
+
+def main():
+    directory = sys.argv[1]
+    nreadouts = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    npairs = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    run_no, file_no = 21221, 1
+    recon = recon_filename(directory, run_no, file_no)
+    pairs = make_recon_file(recon, nreadouts)
+    write_candidates(os.path.join(directory, 'ibd_candidates.txt'), run_no, file_no, pairs)
+    make_ibd_file(os.path.join(directory, 'ibd_pairs.root'), npairs, run_no=run_no, file_no=file_no)
+    print "wrote %s (%d readouts, %d IBD candidates) and ibd_pairs.root (%d pairs)" % (recon, nreadouts, len(pairs), npairs)
+
+if __name__=='__main__':
+    main()
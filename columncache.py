@@ -0,0 +1,211 @@
+# Persistent on-disk cache of decoded ROOT branches, shared by every pass over the same files
+import os
+import json
+import time
+import shutil
+import socket
+import hashlib
+import argparse
+import numpy as np
+
+# Scratch directory of the cache used by roottools.RootTree; unset turns caching off.
+CACHE_DIR_ENV = 'ROOTTOOLS_CACHE'
+CACHE_GB_ENV = 'ROOTTOOLS_CACHE_GB'
+DEFAULT_LIMIT_GB = 50.
+META_NAME = 'meta.json'
+VALUES_NAME = 'values'
+OFFSETS_NAME = 'offsets'
+STALE_SECONDS = 24 * 3600 # Unfinished columns older than this belong to a dead process.
+
+_default = {} # directory -> ColumnCache of default_cache
+
+def default_cache():
+    ''' ColumnCache of $ROOTTOOLS_CACHE limited to $ROOTTOOLS_CACHE_GB, or None when it is unset.'''
+    directory = os.environ.get(CACHE_DIR_ENV)
+    if not directory:
+        return None
+    if directory not in _default:
+        limit = float(os.environ.get(CACHE_GB_ENV, DEFAULT_LIMIT_GB))
+        _default[directory] = ColumnCache(directory, int(limit * 2**30))
+    return _default[directory]
+
+def _map(filename, dtype, count):
+    ''' Read-only memory map of a flat binary column, as a plain ndarray.'''
+    if count == 0:
+        return np.zeros(0, dtype=dtype) # mmap refuses empty files
+    return np.asarray(np.memmap(filename, dtype=dtype, mode='r', shape=(count,)))
+
+class ColumnWriter(object):
+    '''Streams one column into a private directory that commit() renames into the cache.'''
+    def __init__(self, cache, key, dtype, vector, info):
+        self.cache = cache
+        self.key = key
+        self.dtype = np.dtype(dtype)
+        self.vector = vector
+        self.info = info
+        self.tmpdir = '%s.tmp-%s-%d' % (cache.path(key), socket.gethostname(), os.getpid())
+        os.makedirs(self.tmpdir)
+        self.values = open(os.path.join(self.tmpdir, VALUES_NAME), 'wb')
+        self.offsets = open(os.path.join(self.tmpdir, OFFSETS_NAME), 'wb') if vector else None
+        self.nentries = 0
+        self.nvalues = 0
+        if vector:
+            np.zeros(1, dtype='int64').tofile(self.offsets)
+
+    def append(self, values, counts=None):
+        ''' Add the values of the next entries; vector columns also give the number of values of each entry.'''
+        np.asarray(values, dtype=self.dtype).tofile(self.values)
+        if self.vector:
+            offsets = np.cumsum(counts, dtype='int64')
+            (offsets + self.nvalues).tofile(self.offsets)
+            self.nentries += len(offsets)
+        else:
+            self.nentries += len(values)
+        self.nvalues += len(values)
+
+    def commit(self):
+        ''' Move the column into place and return it as ColumnCache.get does.'''
+        self.values.close()
+        if self.offsets is not None:
+            self.offsets.close()
+        meta = dict(self.info, dtype=self.dtype.str, vector=self.vector, entries=self.nentries, values=self.nvalues)
+        with open(os.path.join(self.tmpdir, META_NAME), 'w') as f:
+            json.dump(meta, f)
+        try:
+            os.rename(self.tmpdir, self.cache.path(self.key))
+        except OSError:
+            # another process stored the same column first
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+        return self.cache.get(self.key)
+
+    def abort(self):
+        self.values.close()
+        if self.offsets is not None:
+            self.offsets.close()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+class ColumnCache(object):
+    '''Decoded branches of ROOT files as flat binary columns in a scratch directory.
+
+       Every (file, tree, branch) is one directory named by a hash of the
+       file's real path, size and mtime, the tree, the branch and its dtype,
+       so a rewritten file is a miss. It holds the values, the entry offsets
+       of a vector branch (as JaggedArray) and meta.json; the columns are
+       memory-mapped when used. Columns are written under a private name
+       and renamed into place, so ranks sharing the directory never see a
+       partial one. The mtime of meta.json is the last use: once the cache
+       holds more than limit_bytes the least recently used columns go. The
+       cache keeps no mappings itself; a column's disk space is freed once
+       it is evicted and its last mapping is dropped.
+    '''
+    def __init__(self, directory, limit_bytes):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        self.directory = directory
+        self.limit_bytes = limit_bytes
+
+    def key(self, filename, treename, branchname, dtype):
+        st = os.stat(filename)
+        ident = '\0'.join([os.path.realpath(filename), str(st.st_size), repr(st.st_mtime),
+                           treename, branchname, np.dtype(dtype).str])
+        return hashlib.sha1(ident).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        '''
+        Return newly mapped (values, offsets) of a stored column, offsets
+        None for a scalar branch, or None when it is not in the cache.
+        '''
+        path = self.path(key)
+        metaname = os.path.join(path, META_NAME)
+        try:
+            with open(metaname) as f:
+                meta = json.load(f)
+            values = _map(os.path.join(path, VALUES_NAME), meta['dtype'], meta['values'])
+            offsets = _map(os.path.join(path, OFFSETS_NAME), 'int64', meta['entries'] + 1) if meta['vector'] else None
+            os.utime(metaname, None)
+        except (IOError, OSError, ValueError, KeyError):
+            return None # Missing, or evicted by another process meanwhile.
+        return values, offsets
+
+    def writer(self, key, dtype, vector=False, info=None):
+        ''' ColumnWriter for a column that get() missed; info is kept in meta.json.'''
+        return ColumnWriter(self, key, dtype, vector, info or {})
+
+    def columns(self):
+        ''' [(last use, bytes, key, meta)] of the stored columns, least recently used first.'''
+        found = []
+        for name in os.listdir(self.directory):
+            path = self.path(name)
+            if '.tmp-' in name:
+                continue
+            try:
+                metaname = os.path.join(path, META_NAME)
+                with open(metaname) as f:
+                    meta = json.load(f)
+                used = os.path.getmtime(metaname)
+                size = sum(os.path.getsize(os.path.join(path, fn)) for fn in os.listdir(path))
+            except (IOError, OSError, ValueError):
+                continue
+            found.append((used, size, name, meta))
+        found.sort()
+        return found
+
+    def evict(self, limit_bytes=None, protect=()):
+        '''
+        Remove least recently used columns, except those in protect, until
+        the cache holds at most limit_bytes (default: its limit), and any
+        unfinished column left by a dead process. Returns the bytes kept.
+        Mapped columns stay readable by the processes using them.
+        '''
+        if limit_bytes is None:
+            limit_bytes = self.limit_bytes
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = self.path(name)
+            try:
+                if '.tmp-' in name and now - os.path.getmtime(path) > STALE_SECONDS:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+        columns = self.columns()
+        total = sum(size for used, size, key, meta in columns)
+        for used, size, key, meta in columns:
+            if total <= limit_bytes:
+                break
+            if key in protect:
+                continue
+            shutil.rmtree(self.path(key), ignore_errors=True)
+            total -= size
+        return total
+
+def main():
+    parser = argparse.ArgumentParser(description='Show, trim or clear a decoded column cache.')
+    parser.add_argument('directory', nargs='?', default=os.environ.get(CACHE_DIR_ENV), help='Cache directory (default: $%s)' % CACHE_DIR_ENV)
+    parser.add_argument('--evict', type=float, default=None, metavar='GB', help='Remove least recently used columns down to GB')
+    parser.add_argument('--clear', action='store_true', help='Remove every column')
+    args = parser.parse_args()
+    if not args.directory:
+        parser.error('no cache directory given and $%s is not set' % CACHE_DIR_ENV)
+    cache = ColumnCache(args.directory, 0)
+    if args.clear:
+        args.evict = 0.
+    if args.evict is not None:
+        cache.evict(int(args.evict * 2**30))
+    files = {}
+    for used, size, key, meta in cache.columns():
+        stats = files.setdefault(meta.get('file', '?'), [0, 0, 0.])
+        stats[0] += 1
+        stats[1] += size
+        stats[2] = max(stats[2], used)
+    for filename, (ncolumns, size, used) in sorted(files.iteritems(), key=lambda kv: -kv[1][2]):
+        print "%-70s %3d columns %9.1f MB  used %s" % (filename, ncolumns, size / 1e6, time.strftime('%Y-%m-%d %H:%M', time.localtime(used)))
+    print "%s: %d files, %.2f GB" % (args.directory, len(files), sum(s[1] for s in files.itervalues()) / 2.**30)
+
+if __name__=='__main__':
+    main()
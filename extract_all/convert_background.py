@@ -0,0 +1,339 @@
+# Per-file conversion shared by extract_background.py and mpi_extract_background.py
+import os
+import time
+import collections
+import numpy as np
+import roottools
+import h5tools
+import pipeline
+import timings as timingtools
+from roottools import ismuon, isflasher, ismuon_array, isflasher_array
+
+NFEATURES = 192
+BATCH_SIZE = 10000 # Entries read from the ROOT trees at a time.
+RANGE_SIZE = 10000 # Matched entries per task when a file is split over worker processes.
+TASKS_PER_WORKER = 2 # Ranges submitted or finished but not yet written, per worker; bounds the parent's memory.
+READOUT_BRANCHES = ['triggerNumber', 'detector', 'nHitsAD', 'chargeAD', 'timeAD', 'ring', 'column']
+STATS_BRANCHES = ['triggerNumber', 'MaxQ', 'Quadrant', 'time_PSD', 'time_PSD1', 'MaxQ_2inchPMT', 'NominalCharge']
+OUTPUT_COLUMNS = {'charge': ((NFEATURES,), 'float64'),
+                  'time': ((NFEATURES,), 'float64'),
+                  'class': ((1,), 'int32'),
+                  'trig_no': ((1,), 'int32'),
+                  'detector_no': ((1,), 'int32'),
+                  'run_no': ((1,), 'int32'),
+                  'file_no': ((1,), 'int32'),
+                  'eh': ((1,), 'int32')}
+# Per-source index of a combined (shared or sharded) output: rows start:stop came from one (run, file).
+INDEX_NAME = 'index'
+INDEX_DTYPE = [('run_no', 'int32'), ('file_no', 'int32'), ('start', 'int64'), ('stop', 'int64')]
+
+# 1
+event_dict = {'ibd_prompt':1,
+'ibd_delay':2,
+'muon':3,
+'flasher':4,
+'other':5}
+
+
+def is_ibd_array(ibd_index, trig_nos, file_no, run_no):
+    ibd_prompt_cand, ibd_delay_cand = ibd_index.labels(trig_nos, run_no, file_no)
+    if np.any(ibd_prompt_cand & ibd_delay_cand):
+        assert False, "Labelled as both prompt and delay. Huh?"
+    return ibd_prompt_cand, ibd_delay_cand
+
+
+def is_ibd(ibd_index, entry, file_no, run_no):
+        ibd_prompt_cand, ibd_delay_cand = is_ibd_array(ibd_index, [entry['triggerNumber']], file_no, run_no)
+        if ibd_prompt_cand[0]:
+            ret = 'ibd_prompt'
+        elif ibd_delay_cand[0]:
+            ret = 'ibd_delay'
+        else:
+            ret = False
+        return ret
+
+
+def get_background_type(entry):
+    if ismuon(entry):
+        return event_dict['muon']
+    elif isflasher(entry):
+        return event_dict['flasher']
+    else:
+        return event_dict['other']
+
+
+def get_class(ibd_index, entry, file_no, run_no):
+    ibd_name = is_ibd(ibd_index, entry, file_no, run_no)
+    if ibd_name:
+        return event_dict[ibd_name]
+    else:
+        return get_background_type(entry)
+
+
+def get_background_type_array(entries):
+    muon = ismuon_array(entries)
+    flasher = isflasher_array(entries)
+    return np.where(muon, event_dict['muon'],
+                    np.where(flasher, event_dict['flasher'], event_dict['other'])).astype('int32')
+
+
+def get_class_array(ibd_index, entries, file_no, run_no):
+    classes = get_background_type_array(entries)
+    ibd_prompt_cand, ibd_delay_cand = is_ibd_array(ibd_index, entries['triggerNumber'], file_no, run_no)
+    classes[ibd_prompt_cand] = event_dict['ibd_prompt']
+    classes[ibd_delay_cand] = event_dict['ibd_delay']
+    return classes
+
+
+def get_eh(rootfile):
+    fs_split = rootfile.split('.')
+    return fs_split[4].split('-')[0]
+
+
+def get_run_no(file_string):
+    fs_split = file_string.split('.')
+    return int(fs_split[2])
+def get_file_no(file_string):
+    fs_split = file_string.split('.')
+    return int(fs_split[6].split('_')[1])
+
+
+def get_h5_filename(rootfile):
+    return 'recon.' + rootfile.split('.root')[0].split('recon.')[1] + '.h5'
+
+
+def load_file_list(filename):
+    ''' Return the ROOT file names listed one per line in filename as a numpy string array.'''
+    with open(filename, "r") as f:
+        return np.array([x.strip('\n') for x in f.readlines()])
+
+
+def read_batches(task, timings=None):
+    '''
+    Yield Batches of the matched (readout, stats) entry numbers of one file;
+    task is as for convert_entries. The read stage is added to timings.
+    '''
+    if timings is None:
+        timings = timingtools.StageTimings(None)
+        timings.begin_file(task[0])
+    rootfile, readout_entries, stats_entries, ibd_index = task
+    readout_tree = roottools.makeCalibReadoutTree(rootfile)
+    stats_tree = roottools.makeCalibStatsTree(rootfile)
+    batches = roottools.iterJoinedBatches(readout_tree, stats_tree, readout_entries, stats_entries, READOUT_BRANCHES, STATS_BRANCHES, BATCH_SIZE)
+    try:
+        while True:
+            t0 = time.time()
+            entries = next(batches, None)
+            if entries is None:
+                break
+            timings.add('read', time.time() - t0, len(entries), bytes_decoded=entries.nbytes())
+            yield entries
+    finally:
+        readout_tree.close()
+        stats_tree.close()
+
+
+def make_rows(rootfile, entries, ibd_index, timings):
+    ''' Output columns of one Batch of rootfile; the image and classify stages are added to timings.'''
+    run_no = get_run_no(rootfile)
+    file_no = get_file_no(rootfile)
+    eh = int(get_eh(rootfile)[2:])
+    n = len(entries)
+    with timings.stage('image', n):
+        charge, time_ = roottools.getChargesTimeBatch(entries, preprocess_flag=False, dtype='float64')
+    with timings.stage('classify', n):
+        classes = get_class_array(ibd_index, entries, file_no, run_no)
+    #flatten the 8,24 arrays
+    return {'charge': charge.reshape((n, NFEATURES)),
+            'time': time_.reshape((n, NFEATURES)),
+            'trig_no': entries['triggerNumber'],
+            'detector_no': entries['detector'],
+            'class': classes,
+            'run_no': np.repeat(run_no, n),
+            'file_no': np.repeat(file_no, n),
+            'eh': np.repeat(eh, n)}
+
+
+def convert_entries(task, timings=None):
+    '''
+    Build the output rows for matched (readout, stats) entry numbers of one
+    file. task is (rootfile, readout_entries, stats_entries, ibd_index) so it
+    can be sent to a worker process. Yields one dict of columns per batch;
+    the read, image and classify stages are added to timings if given.
+    '''
+    if timings is None:
+        timings = timingtools.StageTimings(None)
+        timings.begin_file(task[0])
+    for entries in read_batches(task, timings):
+        yield make_rows(task[0], entries, task[3], timings)
+
+
+def convert_range(task):
+    '''
+    convert_entries for one entry range, concatenated; runs in a worker
+    process. Returns (rows or None, stage timings of the range).
+    '''
+    timings = timingtools.StageTimings(None)
+    timings.begin_file(task[0])
+    rows = list(convert_entries(task, timings))
+    stages = timings.current['stages']
+    if not rows:
+        return None, stages
+    return dict((k, np.concatenate([r[k] for r in rows])) for k in rows[0]), stages
+
+
+def join_file(rootfile, timings=None):
+    '''
+    Match the AD readout triggers of rootfile with its stats triggers using
+    only the triggerNumber columns. Returns (readout_entries, stats_entries),
+    one output row per pair. If roottools reads through a column cache, the
+    branches the conversion reads are stored in it first (stage cache).
+    '''
+    if timings is None:
+        timings = timingtools.StageTimings(None)
+        timings.begin_file(rootfile)
+    readout_tree = roottools.makeCalibReadoutTree(rootfile)
+    stats_tree = roottools.makeCalibStatsTree(rootfile)
+    calib_entries = readout_tree.numEntries()
+    stat_entries = stats_tree.numEntries()
+    t1 = time.time()
+    with timings.stage('join', calib_entries + stat_entries):
+        readout_entries, stats_entries = roottools.joinCalibTrees(readout_tree, stats_tree)
+    t2 = time.time()
+    print "it took %d seconds for %i events. Thats %i events per second" % (t2-t1, calib_entries + stat_entries, (calib_entries + stat_entries) / (t2-t1))
+    # with a column cache, decode every branch once here rather than in each worker that reads a range
+    t0 = time.time()
+    cached = readout_tree.cache_branches(READOUT_BRANCHES)
+    cached = stats_tree.cache_branches(STATS_BRANCHES) or cached
+    if cached:
+        timings.add('cache', time.time() - t0, calib_entries + stat_entries)
+    readout_tree.close()
+    stats_tree.close()
+    return readout_entries, stats_entries
+
+
+_pools = {} # nworkers -> multiprocessing.Pool, forked once per process
+
+def worker_pool(nworkers):
+    '''
+    The process's pool of nworkers worker processes, created on first use
+    and reused for every file. Create it before opening any output file:
+    workers forked later keep its descriptor and HDF5 lock open.
+    '''
+    if nworkers not in _pools:
+        import multiprocessing
+        _pools[nworkers] = multiprocessing.Pool(nworkers)
+    return _pools[nworkers]
+
+
+def bounded_imap(pool, func, tasks, window):
+    '''
+    Like pool.imap, but with at most window tasks submitted whose results
+    have not been taken yet, so results wait in the workers rather than
+    piling up in the parent when the consumer is slow.
+    '''
+    tasks = iter(tasks)
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) == window:
+            break
+    while pending:
+        result = pending.popleft().get()
+        task = next(tasks, None)
+        if task is not None:
+            pending.append(pool.apply_async(func, (task,)))
+        yield result
+
+
+def write_rows(rootfile, writer, readout_entries, stats_entries, ibd_index, nworkers=1, timings=None, pipeline_depth=0):
+    '''
+    Convert the matched entries of rootfile from join_file and append the
+    rows to writer, an H5StreamWriter. With nworkers > 1 the entries are
+    split into contiguous ranges of RANGE_SIZE that the process's worker
+    pool converts in parallel, with at most TASKS_PER_WORKER ranges per
+    worker in flight; rows are still written in entry order. Stages run
+    by workers are summed over the workers, and pipeline_depth is not
+    used. Otherwise, with pipeline_depth > 0, reading, building the rows and writing run on their own threads
+    with up to pipeline_depth batches queued between them, and the queue
+    statistics go to timings. Returns the number of rows appended.
+    '''
+    if timings is None:
+        timings = timingtools.StageTimings(None)
+        timings.begin_file(rootfile)
+    num_entries = len(readout_entries)
+    first = len(writer)
+    t1 = time.time()
+    if nworkers > 1:
+        # only this file's candidates travel to the workers
+        ibd_index = ibd_index.select(get_run_no(rootfile), get_file_no(rootfile))
+        tasks = [(rootfile, readout_entries[start:start+RANGE_SIZE], stats_entries[start:start+RANGE_SIZE], ibd_index)
+                 for start in xrange(0, num_entries, RANGE_SIZE)]
+        pool = worker_pool(nworkers)
+        def batches():
+            for rows, stages in bounded_imap(pool, convert_range, tasks, TASKS_PER_WORKER * nworkers):
+                timings.merge(stages)
+                if rows is not None:
+                    yield rows
+        batches = batches()
+    elif pipeline_depth > 0:
+        task = (rootfile, readout_entries, stats_entries, ibd_index)
+        batches = pipeline.Pipeline(read_batches(task, timings),
+                                    [('image', lambda entries: make_rows(rootfile, entries, ibd_index, timings))],
+                                    pipeline_depth, sink_name='write')
+    else:
+        batches = convert_entries((rootfile, readout_entries, stats_entries, ibd_index), timings)
+    for rows in batches:
+        print "%i of %i entries" % (len(writer) - first, num_entries)
+        with timings.stage('write', len(rows['trig_no'])):
+            writer.append(rows)
+    if isinstance(batches, pipeline.Pipeline):
+        timings.add_queues(batches.report())
+    t2 = time.time()
+    print "it took %d seconds for %i events. Thats %i events per second" % (t2-t1, num_entries, num_entries / (t2-t1))
+    return len(writer) - first
+
+
+def convert_file(rootfile, h5_path, ibd_index, profile, nworkers=1, timings=None, pipeline_depth=0, joined=None):
+    '''
+    Convert one ROOT file to h5_path, see join_file and write_rows; joined
+    is the result of join_file if that already ran. Stage times go to
+    timings, a StageTimings between begin_file and end_file. Returns the
+    number of rows written.
+    '''
+    import h5py
+    if timings is None:
+        timings = timingtools.StageTimings(None)
+        timings.begin_file(rootfile)
+    readout_entries, stats_entries = joined if joined is not None else join_file(rootfile, timings)
+    if nworkers > 1:
+        worker_pool(nworkers) # forked before the output is open
+
+    # write to a temporary name so an interrupted rank never leaves a truncated h5_path behind
+    h5_tmp_path = h5_path + '.tmp'
+    h5f = h5py.File(h5_tmp_path, 'w')
+    writer = h5tools.H5StreamWriter(h5f, OUTPUT_COLUMNS, expected_rows=len(readout_entries), profile=profile)
+    write_rows(rootfile, writer, readout_entries, stats_entries, ibd_index, nworkers, timings, pipeline_depth)
+    with timings.stage('write'):
+        nrows = writer.close()
+        h5f.close()
+    timings.add('write', 0, bytes_written=os.path.getsize(h5_tmp_path))
+    os.rename(h5_tmp_path, h5_path)
+    return nrows
+
+
+def index_row(rootfile, start, stop):
+    ''' One INDEX_DTYPE record: rows start:stop of a combined output came from rootfile.'''
+    return (get_run_no(rootfile), get_file_no(rootfile), start, stop)
+
+
+def write_index(group, rows):
+    '''
+    Store the INDEX_DTYPE records rows as the INDEX_NAME dataset of group,
+    so readers of a combined output can find the rows of one (run, file).
+    '''
+    index = np.array(rows, dtype=INDEX_DTYPE)
+    if INDEX_NAME in group:
+        del group[INDEX_NAME]
+    group.create_dataset(INDEX_NAME, data=index)
+    return index
@@ -0,0 +1,154 @@
+###############################3######
+# Build one catalog file over the converted outputs: virtual datasets that
+# concatenate every column of every recon.*.h5 (or shard), the row range of
+# each (run, file) and the rows of each class, so a training job can slice
+# the whole campaign through a single open file.
+# usage: python make_catalog.py <output dir or .h5 files...> [--out catalog.h5]
+####################################333
+
+import os
+import glob
+import argparse
+import numpy as np
+import h5py
+import convert_background
+
+CATALOG_NAME = 'catalog.h5'
+SUMMARY_COLUMNS = ['class', 'run_no', 'file_no', 'eh', 'detector_no'] # Read from every source to build the row lists.
+
+def find_sources(paths, catalog):
+    ''' Expand directories to their .h5 files, skipping the catalog and unfinished .tmp outputs.'''
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            sources.extend(sorted(glob.glob(os.path.join(path, '*.h5'))))
+        else:
+            sources.append(path)
+    catalog = os.path.abspath(catalog)
+    return [fn for fn in sources if os.path.abspath(fn) != catalog]
+
+def has_virtual():
+    ''' Virtual datasets need h5py 2.9 and HDF5 1.10.'''
+    return hasattr(h5py, 'VirtualLayout') and h5py.version.hdf5_version_tuple >= (1, 10)
+
+def scan_source(filename):
+    '''
+    Return (nrows, {column: (row shape, dtype)}, summary columns, index rows)
+    of one converter output. Index rows are relative to the file; a file
+    without an index dataset holds a single (run, file).
+    '''
+    with h5py.File(filename, 'r') as h5f:
+        nrows = len(h5f['trig_no'])
+        columns = dict((name, (h5f[name].shape[1:], h5f[name].dtype)) for name in convert_background.OUTPUT_COLUMNS)
+        summary = dict((name, h5f[name][:, 0]) for name in SUMMARY_COLUMNS)
+        if convert_background.INDEX_NAME in h5f:
+            index = h5f[convert_background.INDEX_NAME][:]
+        elif nrows:
+            index = np.array([(summary['run_no'][0], summary['file_no'][0], 0, nrows)], dtype=convert_background.INDEX_DTYPE)
+        else:
+            index = np.zeros(0, dtype=convert_background.INDEX_DTYPE)
+    return nrows, columns, summary, index
+
+def build_catalog(sources, catalog, virtual=True):
+    '''
+    Write catalog with, over all sources in order:
+      <column>        virtual dataset of the concatenated rows (if virtual)
+      index           (run_no, file_no, start, stop) of every source file
+      index_eh        experimental hall of each index row
+      sources         source file names, relative to the catalog directory
+      source_offsets  first row of each source and the total at the end
+      rows/<class>    ascending row numbers of each class of event_dict
+    Returns the total number of rows.
+    '''
+    catalog_dir = os.path.dirname(os.path.abspath(catalog))
+    columns = None
+    offsets = [0]
+    summaries = dict((name, []) for name in SUMMARY_COLUMNS)
+    indices = []
+    index_eh = []
+    for filename in sources:
+        nrows, source_columns, summary, index = scan_source(filename)
+        if columns is None:
+            columns = source_columns
+        elif source_columns != columns:
+            raise ValueError('%s has other column shapes or dtypes than %s' % (filename, sources[0]))
+        for name in SUMMARY_COLUMNS:
+            summaries[name].append(summary[name])
+        index_eh.append(np.array([summary['eh'][start] if stop > start else 0
+                                  for start, stop in zip(index['start'], index['stop'])], dtype='int32'))
+        index['start'] += offsets[-1]
+        index['stop'] += offsets[-1]
+        indices.append(index)
+        offsets.append(offsets[-1] + nrows)
+    total = offsets[-1]
+
+    tmpname = catalog + '.tmp'
+    with h5py.File(tmpname, 'w') as h5f:
+        if virtual and columns is not None:
+            for name, (shape, dtype) in sorted(columns.iteritems()):
+                layout = h5py.VirtualLayout(shape=(total,) + shape, dtype=dtype)
+                for i, filename in enumerate(sources):
+                    lo, hi = offsets[i], offsets[i + 1]
+                    if hi > lo:
+                        # relative names resolve against the catalog's directory
+                        layout[lo:hi] = h5py.VirtualSource(os.path.relpath(os.path.abspath(filename), catalog_dir),
+                                                           name, shape=(hi - lo,) + shape)
+                h5f.create_virtual_dataset(name, layout)
+        h5f.create_dataset(convert_background.INDEX_NAME,
+                           data=np.concatenate(indices) if indices else np.zeros(0, dtype=convert_background.INDEX_DTYPE))
+        h5f.create_dataset('index_eh', data=np.concatenate(index_eh) if index_eh else np.zeros(0, dtype='int32'))
+        h5f.create_dataset('sources', data=np.array([os.path.relpath(os.path.abspath(fn), catalog_dir) for fn in sources], dtype='S'))
+        h5f.create_dataset('source_offsets', data=np.array(offsets, dtype='int64'))
+        classes = np.concatenate(summaries['class']) if sources else np.zeros(0, dtype='int32')
+        rows = h5f.create_group('rows')
+        for name, label in sorted(convert_background.event_dict.iteritems(), key=lambda kv: kv[1]):
+            rows.create_dataset(name, data=np.flatnonzero(classes == label).astype('int64'))
+    os.rename(tmpname, catalog)
+    return total
+
+def class_rows(catalog, name, eh=None, run_no=None):
+    '''
+    Row numbers of class name in an open catalog, optionally only those of
+    one hall or run; the index narrows them without reading any source.
+    Index a virtual column with them, e.g. catalog['charge'][rows[:1000]].
+    '''
+    rows = catalog['rows'][name][:]
+    if eh is None and run_no is None:
+        return rows
+    index = catalog[convert_background.INDEX_NAME][:]
+    select = np.ones(len(index), dtype=bool)
+    if run_no is not None:
+        select &= index['run_no'] == run_no
+    if eh is not None:
+        select &= catalog['index_eh'][:] == eh
+    # rows and the index ranges are ascending, so each range is one slice of rows
+    lo = np.searchsorted(rows, index['start'][select], side='left')
+    hi = np.searchsorted(rows, index['stop'][select], side='left')
+    if len(lo) == 0:
+        return rows[:0]
+    return np.concatenate([rows[a:b] for a, b in zip(lo, hi)])
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a catalog with virtual datasets over converted HDF5 outputs.')
+    parser.add_argument('inputs', nargs='+', help='Output directories or .h5 files')
+    parser.add_argument('--out', default=None, help='Catalog file (default: <first input dir>/%s)' % CATALOG_NAME)
+    parser.add_argument('--no-virtual', action='store_true', help='Only write the index and row lists')
+    args = parser.parse_args()
+    out = args.out
+    if out is None:
+        first = args.inputs[0]
+        out = os.path.join(first if os.path.isdir(first) else os.path.dirname(first), CATALOG_NAME)
+    virtual = not args.no_virtual
+    if virtual and not has_virtual():
+        print "h5py %s / HDF5 %s has no virtual datasets; writing the index and row lists only" % (
+            h5py.version.version, h5py.version.hdf5_version)
+        virtual = False
+    sources = find_sources(args.inputs, out)
+    total = build_catalog(sources, out, virtual)
+    print "%s: %d rows from %d files" % (out, total, len(sources))
+    with h5py.File(out, 'r') as h5f:
+        for name in sorted(h5f['rows'], key=lambda n: convert_background.event_dict[n]):
+            print "  %-12s %10d" % (name, len(h5f['rows'][name]))
+
+if __name__=='__main__':
+    main()
@@ -3,105 +3,125 @@
 # Make supervised learning dataset
 ####################################333
 
-import os
 import sys
-#import h5py
-from collections import defaultdict
 import roottools
-from roottools import ismuon, isflasher
-import array
+import sampling
+import transforms
+import convert_background
 import numpy as np
-import itertools
-import pickle as pkl
-#import pandas
 import h5py
 import time
 import argparse
 
 NFEATURES = 192 * 2
+CHUNK_ROWS = 10000 # Rows read from an HDF5 input at a time.
+classnames = ['ad_init', 'ad_delay', 'muon', 'flasher', 'other']
 
-def main():
-    #print "usage: python large_make-dif.py num localFid globalFid"
-    #num is the total number of events that tobe extracted
-    #localfid is within a taskfarmer run, e.g., if we run 20 tasks in a single taskfarmer master run, then localid is between 0-19
-    #globalfid is id between different taskfarmer run, e.g.,if we have 2 taskfarmer master run, then the first run has globalfid as 0, and the second one starts after the total number of first tasks, which is 20
-    if len(sys.argv)<3:
-        print "follow usage.."
-        sys.exit(1)
-    #open Filelist and pick the the file
-    with open("./FileList-6Oct-Official-1") as f:
-        content = [x.strip('\n') for x in f.readlines()]
-    N = int(sys.argv[1]) # Number of examples from each class.20k
-    fileId=int(sys.argv[2])
-#    N = 8* 10**5 # Number of examples from each class.
-    nclasses = 5
-    classnames = ['ad_init', 'ad_delay', 'muon', 'flasher', 'other']
-    data = {}
-    for name in classnames:
-        data[name] = np.zeros((N, NFEATURES), dtype='float32')
+def make_stage(time_window=False, pad=0):
+    '''
+    FeatureStage for the inputs rows: log scaled charge then time, as
+    getChargesTime(entry, preprocess_flag=True) gives, optionally with time
+    scaled to the trigger window and the images unrolled with pad columns.
+    '''
+    steps = [transforms.LogScale()]
+    if time_window:
+        steps.append(transforms.TimeWindow())
+    return transforms.FeatureStage(steps, transforms.CylinderPad(pad) if pad else None)
+
+def root_batches(rootfile, stage):
+    '''
+    (labels, rows) batches of the AD events of a ROOT file, labelled muon,
+    flasher or other by index into classnames. Rows are stage's buffers,
+    valid until the next batch.
+    '''
+    readout_tree = roottools.makeCalibReadoutTree(rootfile)
+    stats_tree = roottools.makeCalibStatsTree(rootfile)
+    readout_entries, stats_entries = roottools.joinCalibTrees(readout_tree, stats_tree, detectors=[0,1,2,3])
+    for entries in roottools.iterJoinedBatches(readout_tree, stats_tree, readout_entries, stats_entries,
+                                               convert_background.READOUT_BRANCHES, convert_background.STATS_BRANCHES,
+                                               convert_background.BATCH_SIZE):
+        charge, time_ = roottools.getChargesTimeBatch(entries, preprocess_flag=False, out=stage.images(len(entries)))
+        labels = convert_background.get_background_type_array(entries) - 1 # event_dict numbers classes from 1
+        yield labels, {'inputs': stage(charge, time_)}
 
-    # AD data
-#    fn = '/global/homes/p/pjsadows/ad/ibd_%d.h5' % N
-    Nad = 16 + fileId
-    fn = '/project/projectdirs/das/wbhimji/mantissa-hep/dayabay/data/ad/ibd_v3_time/%d.h5' % Nad
-    f = h5py.File(fn, 'r')
-    charges = f['charges']
-    data['ad_init'] = charges[:N, 0:NFEATURES] # change this for new files with 2* nfeatures
-    data['ad_delay'] = charges[:N, NFEATURES:2*NFEATURES]
-    f.close()   
- 
-    # Muon, flasher, other.
-    counts = {'muon':0, 'flasher':0, 'other':0}
-#    rootfile = 'a/project/projectdirs/dayabay/scratch/ynakajim/mywork/data_samples/recon.Neutrino.0021221.Physics.EH1-Merged.P14A-P._0001.root'
-    rootfile = content[fileId]
-    for entry in roottools.rootfileiter(rootfile):
-        if entry['detector'] not in [0,1,2,3]:
-            continue # Not AD detector
-        charge,time = roottools.getChargesTime(entry, preprocess_flag=True)
-        if ismuon(entry):
-            counts['muon'] += 1
-            if counts['muon'] <= N:
-                data['muon'][counts['muon']-1,:] = np.hstack((charge.flatten(),time.flatten()))
-        elif isflasher(entry):
-            counts['flasher'] += 1
-            if counts['flasher'] <= N:
-                data['flasher'][counts['flasher']-1,:] =  np.hstack((charge.flatten(),time.flatten()))
-        else:
-            counts['other'] += 1 # TODO: should we ignore post-muon noise?
-            if counts['other'] <= N:
-                data['other'][counts['other']-1,:] =  np.hstack((charge.flatten(),time.flatten()))
+def is_pair_file(filename):
+    ''' AD pair files hold charges rows of ready-made prompt and delayed features.'''
+    if not filename.endswith('.h5'):
+        return False
+    with h5py.File(filename, 'r') as f:
+        return 'charges' in f
 
-        if np.all(np.array(counts.values()) > N):
-            print np.array(counts.values())
-            print np.array(counts.values()) > N
-            break
+def h5_batches(h5file, stage):
+    '''
+    (labels, rows) batches of a converted file (charge, time and class
+    columns, see convert_background) or of an AD pair file whose charges
+    rows hold the prompt and the delayed event side by side.
+    '''
+    with h5py.File(h5file, 'r') as f:
+        if 'charges' in f:
+            charges = f['charges']
+            for start in xrange(0, len(charges), CHUNK_ROWS):
+                pairs = charges[start:start+CHUNK_ROWS]
+                n = len(pairs)
+                yield np.repeat([0, 1], n), {'inputs': np.vstack((pairs[:, 0:NFEATURES], pairs[:, NFEATURES:2*NFEATURES]))}
+            return
+        for start in xrange(0, len(f['class']), CHUNK_ROWS):
+            labels = f['class'][start:start+CHUNK_ROWS, 0] - 1
+            n = len(labels)
+            charge, time_ = stage.images(n)
+            # HDF5 converts the stored dtype straight into the image buffers
+            f['charge'].read_direct(charge.reshape((n, -1)), np.s_[start:start+n])
+            f['time'].read_direct(time_.reshape((n, -1)), np.s_[start:start+n])
+            yield labels, {'inputs': stage(charge, time_)}
+
+def main():
+    parser = argparse.ArgumentParser(description='Make a class-balanced, shuffled training set from ROOT and HDF5 inputs.')
+    parser.add_argument('N', type=int, help='Examples per class')
+    parser.add_argument('fileId', type=int, help='Index into the file list of the ROOT file to sample (and of the AD file)')
+    parser.add_argument('--inputs', nargs='+', default=None,
+                        help='ROOT files, converted .h5 outputs or AD pair files to sample instead')
+    parser.add_argument('--budget-mb', type=float, default=4096, help='Memory for the per-class reservoirs')
+    parser.add_argument('--shard-rows', type=int, default=100000, help='Rows per output shard')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--time-window', action='store_true', help='Scale hit times to [0, 1] over the trigger window')
+    parser.add_argument('--pad', type=int, default=0, help='Columns of cylindrical wrap-around added on each side of the images')
+    args = parser.parse_args()
+    N = args.N # Number of examples from each class.20k
+    fileId = args.fileId
+    nclasses = len(classnames)
+    if args.inputs is None:
+        #open Filelist and pick the the file
+        with open("./FileList-6Oct-Official-1") as f:
+            content = [x.strip('\n') for x in f.readlines()]
+        Nad = 16 + fileId
+        args.inputs = ['/project/projectdirs/das/wbhimji/mantissa-hep/dayabay/data/ad/ibd_v3_time/%d.h5' % Nad,
+                       content[fileId]]
 
-    print counts
+    if (args.time_window or args.pad) and any(is_pair_file(fn) for fn in args.inputs):
+        parser.error('AD pair files hold %d ready-made features; --time-window and --pad need ROOT or converted inputs' % NFEATURES)
+    stage = make_stage(args.time_window, args.pad)
+    columns = {'inputs': ((stage.nfeatures,), 'float32')}
+    # Every class keeps a uniform sample of its events over all inputs in a fixed buffer.
+    capacity = min(N, sampling.capacity_for(args.budget_mb * 2**20, columns, nclasses))
+    if capacity < N:
+        print "Memory budget holds %d examples per class, not %d" % (capacity, N)
+    reservoir = sampling.ClassReservoir(range(nclasses), capacity, columns, seed=args.seed)
+    t1 = time.time()
+    for filename in args.inputs:
+        batches = h5_batches(filename, stage) if filename.endswith('.h5') else root_batches(filename, stage)
+        for labels, rows in batches:
+            reservoir.add(labels, rows)
+        print filename, dict((classnames[label], reservoir.seen[label]) for label in reservoir.classes)
+    print "sampled in %d seconds" % (time.time() - t1)
 
-    X = np.vstack([data[name] for name in classnames])
-    Y = np.zeros((nclasses*N, nclasses), dtype='float32')
-    #Y = np.arange(nclasses*N, dtype='int32') / N #
-    for i in range(nclasses*N):
-        label = i / N
-        Y[i,label] = 1.0        
- 
-    if False:
-        # Randomize examples.
-        perm = np.random.permutation(N*nclasses)
-        X = X[perm, :]
-        Y = Y[perm]
-        
-    # Write
-#    outfile = 'single_withtime_%d.h5' % N
-    outfile = "./single_withtime_v2_"+str(fileId)+".h5"
-    f = h5py.File(outfile, "w")
-    dset = f.create_dataset("inputs", X.shape, dtype='float32')
-    dset2 = f.create_dataset("targets", Y.shape, dtype='float32')
-    dset[0:N*nclasses,...] = X
-    dset2[0:N*nclasses] = Y
-    f.close()
-    #np.savetxt('single_%d.csv' % N, np.hstack([Y.reshape((-1,1)), X]))
-    #np.savetxt('single_%d.csv' % N, np.hstack([Y, X]))
+    labels, rows = reservoir.balanced()
+    n = len(labels) // nclasses
+    if n < N:
+        print "Scarcest class has %d examples, every class is cut to that" % n
+    targets = np.zeros((len(labels), nclasses), dtype='float32')
+    targets[np.arange(len(labels)), labels] = 1.0
+    outfiles = sampling.write_shards("./single_withtime_v2_"+str(fileId), {'inputs': rows['inputs'], 'targets': targets}, args.shard_rows)
+    print "%d examples per class in %s" % (n, ', '.join(outfiles))
 
 
 if __name__=='__main__':
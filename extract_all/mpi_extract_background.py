@@ -6,211 +6,312 @@
 
 import os
 import sys
-#import h5py
-from collections import defaultdict
-import roottools #move to /global/common
-from roottools import ismuon, isflasher
-import array
-import numpy as np
-import itertools
-import pickle as pkl
-#import pandas
-import h5py
+import ibdtools
+import h5tools
+import columncache
+import mpitools
+import convert_background
+import manifest
+import pipeline
+import timings
+import traceback
 import time
 import argparse
-import itertools
-import pandas
-from mpi4py import MPI
+import numpy as np
 
 # In[ ]:
 
-mpi_rank = int(sys.argv[1]) if len(sys.argv) > 2 else  MPI.COMM_WORLD.Get_rank()
-nproc = int(sys.argv[2]) if len(sys.argv) > 2 else  MPI.COMM_WORLD.Get_size()
+parser = argparse.ArgumentParser(description='Convert Daya Bay ROOT files to HDF5 with MPI.')
+parser.add_argument('rank', nargs='?', type=int, help='Rank to run as without MPI (give nproc too)')
+parser.add_argument('nproc', nargs='?', type=int, help='Number of ranks to run as without MPI')
+parser.add_argument('--schedule', default=None, choices=['dynamic', 'static'],
+                    help='Hand files to ranks as they finish (dynamic, the default) or round-robin up front '
+                         '(static, the only one with --output shared)')
+parser.add_argument('--profile', default='float64', choices=sorted(h5tools.PROFILES),
+                    help='Output precision and compression profile')
+parser.add_argument('--workers', type=int, default=1,
+                    help='Processes converting entry ranges of each file in parallel')
+parser.add_argument('--output', default='files', choices=['files', 'shared', 'shards'],
+                    help='One .h5 per ROOT file, one parallel-HDF5 file written by all ranks, or one shard per rank')
+parser.add_argument('--pipeline', type=int, default=0, metavar='DEPTH',
+                    help='Read, build rows and write each file on three threads with DEPTH batches queued between them '
+                         '(only with --workers 1)')
+parser.add_argument('--prefetch', action='store_true',
+                    help='Join the next file on a thread while the current one is converted (not with --output shared). '
+                         'With a column cache ($ROOTTOOLS_CACHE) the thread also decodes the branches the conversion '
+                         'reads into it; otherwise only the trigger columns of the join are read ahead')
+parser.add_argument('--resume', action='store_true',
+                    help='Redo every file the manifest does not record as done, even if its output exists')
+parser.add_argument('--manifest', default=None,
+                    help='Directory of per-rank JSON-lines manifests (default: <output dir>/manifest)')
+parser.add_argument('--timings', default=None,
+                    help='Directory for per-rank stage timings (default: <output dir>/timings)')
+args = parser.parse_args()
+if args.workers > 1 and args.pipeline > 0:
+    parser.error('--pipeline runs the stages of one process on threads; it cannot be combined with --workers > 1')
+if args.output != 'files' and args.resume:
+    parser.error('--resume needs --output files; rerun a shared or sharded output from scratch')
+if args.output == 'shared' and args.nproc is not None:
+    parser.error('--output shared needs MPI')
+# the shared file needs every file's row count before any rank writes, so its files are joined up front round-robin
+if args.output == 'shared' and args.schedule == 'dynamic':
+    parser.error('--output shared joins files round-robin; it cannot use --schedule dynamic')
+if args.output == 'shared' and args.prefetch:
+    parser.error('--output shared joins every file before converting any; --prefetch does not apply')
+if args.schedule is None:
+    args.schedule = 'static' if args.output == 'shared' else 'dynamic'
+if args.nproc is None:
+    from mpi4py import MPI # Only needed when launched under MPI.
+
+mpi_rank = args.rank if args.nproc is not None else  MPI.COMM_WORLD.Get_rank()
+nproc = args.nproc if args.nproc is not None else  MPI.COMM_WORLD.Get_size()
+if args.output == 'shared' and nproc > 1 and not h5tools.has_parallel():
+    # fail before any rank joins its files, not when the shared file is opened
+    parser.error('--output shared on %d ranks needs h5py built with MPI (parallel HDF5); use --output shards' % nproc)
 
 #offset = int(sys.argv[1]) if len(sys.argv) > 1 else 0
 file_start_idx = mpi_rank  #+ offset
 #file_idx = int(sys.argv[1])
 
 
-# In[2]:
-
-NFEATURES = 192
-
-
 # In[3]:
 
 filename = '/global/homes/p/pjsadows/data/dayabay/ibd_candidates_eh1.txt' # Files containing list of AD candidates.
-X = pandas.read_csv(filename, delimiter='\t')
-
-
-# In[4]:
-
-# 1 
-event_dict = {'ibd_prompt':1,
-'ibd_delay':2, 
-'muon':3,
-'flasher':4, 
-'other':5}
-
-
-# In[84]:
-
-def is_ibd(entry, file_no, run_no):
-        ibds = X[(X['RunNo']==run_no) & (X['FileNo']==file_no) ]
-        ibd_prompt_cand = any(ibds[ibds['trigno_prompt'] == entry['triggerNumber']].any())
-        ibd_delay_cand = any(ibds[ibds['trigno_delayed'] == entry['triggerNumber']].any())
-        if ibd_prompt_cand and ibd_delay_cand:
-            assert False, "Labelled as both prompt and delay. Huh?"
-        elif ibd_prompt_cand:
-            ret = 'ibd_prompt'
-        elif ibd_delay_cand:
-            ret = 'ibd_delay'
-        else:
-            ret = False
-        return ret
-        
-
-
-# In[6]:
-
-def get_background_type(entry):
-    if ismuon(entry):
-        return event_dict['muon']
-    elif isflasher(entry):
-        return event_dict['flasher']
-    else:
-        return event_dict['other']
-
-
-# In[7]:
-
-def get_class(entry, file_no, run_no):
-    ibd_name = is_ibd(entry, file_no, run_no)
-    if ibd_name:
-        return event_dict[ibd_name]
-    else:
-        return get_background_type(entry)
-
-
-# In[8]:
-
-def get_eh(rootfile):
-    fs_split = rootfile.split('.')
-    return fs_split[4].split('-')[0]
-
-
-# In[9]:
-
-def get_run_no(file_string):
-    fs_split = file_string.split('.')
-    return int(fs_split[2])
-def get_file_no(file_string):
-    fs_split = file_string.split('.')
-    return int(fs_split[6].split('_')[1])
+#with open("./FileList-6Oct-Official-1") as f:
+file_list_name = "/global/homes/r/racah/projects/dayabay-data-conversion/extract_all/Unprocessed_FileList-22Mar-1-2"
 
 
 # In[10]:
 
-
-#with open("./FileList-6Oct-Official-1") as f:
-with open("/global/homes/r/racah/projects/dayabay-data-conversion/extract_all/Unprocessed_FileList-22Mar-1-2", "r") as f:
-   content = [x.strip('\n') for x in f.readlines()]
+if args.nproc is None:
+    # rank 0 reads both tables; every node then holds one shared copy instead of each rank reading them
+    ibd_table = content = None
+    if mpi_rank == 0:
+        ibd_table = ibdtools.load_ibd_index(filename).table()
+        content = convert_background.load_file_list(file_list_name)
+    ibd_index = ibdtools.IBDIndex.from_table(mpitools.shared_array(MPI.COMM_WORLD, ibd_table))
+    content = mpitools.shared_array(MPI.COMM_WORLD, content)
+else:
+    ibd_index = ibdtools.load_ibd_index(filename)
+    content = convert_background.load_file_list(file_list_name)
 
 end = len(content)
+path = '/project/projectdirs/paralleldb/spark/benchmarks/nmf/daya-data'
+manifest_dir = args.manifest or os.path.join(path, 'manifest')
+file_manifest = manifest.Manifest(manifest_dir, mpi_rank)
+timings_dir = args.timings or os.path.join(path, 'timings')
+file_timings = timings.StageTimings(mpi_rank)
+if not args.resume:
+    completed = set()
+elif args.nproc is None:
+    completed = MPI.COMM_WORLD.bcast(manifest.completed(manifest_dir) if mpi_rank == 0 else None, root=0)
+else:
+    completed = manifest.completed(manifest_dir)
+if args.prefetch and mpi_rank == 0 and columncache.default_cache() is None:
+    print "--prefetch without a column cache ($ROOTTOOLS_CACHE) reads only the join columns ahead"
+if args.workers > 1:
+    # fork the workers before any output file is open, so they hold none of its descriptors
+    convert_background.worker_pool(args.workers)
 # In[67]:
 
-for file_idx in range(file_start_idx,end,nproc):
-	print file_idx
-	rootfile = content[file_idx]
-	h5_filename = 'recon.' + rootfile.split('.root')[0].split('recon.')[1] + '.h5'
-        path = '/project/projectdirs/paralleldb/spark/benchmarks/nmf/daya-data'
-	full_path = os.path.join(path, h5_filename)
-	print full_path
-	if os.path.exists(full_path):
-		print "Whoa: %s already exists. Skipping.." % full_path
-		continue
-	run_no = get_run_no(rootfile)
-	file_no = get_file_no(rootfile)
-	eh = int(get_eh(rootfile)[2:])
-
-
-	# In[112]:
-
-	index=0
-	stat_entries = roottools.get_num_stat_entries(rootfile)
-	calib_entries =roottools.get_num_readout_entries(rootfile)
-	entries = {}
-	t1 = time.time()
-
-	#these two for loops will be slow
-	# make a hash table mapping triggerNumber to charge, time info entry
-	for entry1 in roottools.calibReadoutIter(rootfile):
-	    if entry1['detector']  in [0,1,2,3,4]:
-		entries[entry1['triggerNumber']] = entry1
-	t2 = time.time()
-	print "it took %d seconds for %i events. Thats %i events per second" % (t2-t1, calib_entries, calib_entries / (t2-t1))
-
-	t1 = time.time()
-	#if a flasher stat entry has the same triggerNumber as a readout entry, merge them
-	for entry2 in roottools.calibStatsIter(rootfile):
-	    if entry2['triggerNumber'] in entries:
-		entries[entry2['triggerNumber']].update(entry2)
-	t2 = time.time()
-	print "it took %d seconds for %i events. Thats %i events per second" % (t2-t1, stat_entries, stat_entries / (t2-t1))
-	#now go thru and so normal parsing (this should be quick)
-
-
-	# In[109]:
-
-	num_entries = len(entries)
-	dataset_keys = ['class', 'charge', 'time', 'trig_no', 'detector_no']
-	data = {}
-	for k in dataset_keys:
-	    if k == 'charge' or k=='time':
-		data[k] = np.zeros((num_entries,NFEATURES), dtype="float64") #h5py file here?
-	    else:
-		data[k] = np.zeros((num_entries,1), dtype='int32')
-	data['run_no'] = run_no * np.ones((num_entries,1), dtype='int32')
-	data['file_no'] = file_no * np.ones((num_entries,1), dtype='int32')
-	data['eh'] = eh * np.ones((num_entries,1), dtype='int32')
-
-
-	# In[113]:
-
-	index=0
-	for entry in entries.values():
-	#     if entry['detector'] not in [0,1,2,3]:
-	#         continue # Not AD detector 
-	    d ={}
-	    d['charge'],d['time'] = roottools.getChargesTime(entry, preprocess_flag=False, dtype='float64')
-	    if index % 1000 == 0:
-		print "%i of %i entries" % (index, len(entries))
-	    #flatten the 8,24 arrays
-	    for k in ['charge', 'time']:
-		d[k] = d[k].flatten()
-	    d['trig_no'] = entry['triggerNumber']
-	    d['detector_no'] = entry['detector']
-	    d['class'] = get_class(entry,file_no, run_no)
-	    for k,v in d.iteritems():
-		data[k][index] = v
-	    index += 1
-	 
-
-
-	# In[115]:
-
-	#h5_filename = 'recon.' + rootfile.split('.root')[0].split('recon.')[1] + '.h5'
-	#print h5_filename
-	#path = '/project/projectdirs/paralleldb/spark/benchmarks/nmf/daya-data'#  if len(sys.argv) < 3 else sys.argv[2]
-	h5_path = full_path #os.path.join(path, h5_filename)
-	print h5_path
-
-
-	# In[116]:
-
-	h5f = h5py.File(h5_path, 'w')
-	for k,v in data.iteritems():
-	     h5f.create_dataset(k,data=v[:index]) # this is importatn to get rid of zero rows
-	h5f.close()
-	os.chown(h5_path,61228,70018) #changes file to be owned by racah and in group dasrepo
-
+def wanted(rootfile):
+    ''' False for a file whose per-file output is already done; combined outputs always redo every file.'''
+    if args.output != 'files':
+        return True
+    full_path = os.path.join(path, convert_background.get_h5_filename(rootfile))
+    if args.resume:
+        # outputs the manifest does not vouch for (e.g. from a killed rank) are redone
+        if rootfile in completed:
+            print "%s is done according to the manifest. Skipping.." % full_path
+            return False
+    elif os.path.exists(full_path):
+        print "Whoa: %s already exists. Skipping.." % full_path
+        return False
+    return True
+
+def join_ahead(rootfile):
+    '''
+    join_file on the prefetch thread, with its own stage timings for the
+    file's record. join_file also fills the column cache, if there is one,
+    with the branches the conversion reads.
+    '''
+    ahead = timings.StageTimings(mpi_rank)
+    ahead.begin_file(rootfile)
+    try:
+        joined = convert_background.join_file(rootfile, ahead)
+    except Exception:
+        joined = None # joined again by the converter, which records the failure
+    return rootfile, joined, ahead.current['stages']
+
+def convert_file(rootfile, joined=None, stages=None):
+    h5_filename = convert_background.get_h5_filename(rootfile)
+    full_path = os.path.join(path, h5_filename)
+    print full_path
+    file_manifest.started(rootfile, full_path)
+    t1 = time.time()
+    file_timings.begin_file(rootfile)
+    if stages:
+        file_timings.merge(stages)
+    try:
+        nrows = convert_background.convert_file(rootfile, full_path, ibd_index, h5tools.PROFILES[args.profile], args.workers, file_timings,
+                                                args.pipeline, joined)
+        os.chown(full_path,61228,70018) #changes file to be owned by racah and in group dasrepo
+    except Exception:
+        traceback.print_exc()
+        file_manifest.failed(rootfile, full_path, traceback.format_exc().splitlines()[-1], time.time() - t1)
+        file_timings.end_file('failed')
+        file_timings.save(timings_dir)
+        return
+    file_manifest.done(rootfile, full_path, nrows, time.time() - t1)
+    file_timings.end_file()
+    file_timings.save(timings_dir)
+
+
+# In[90]:
+
+# Combined outputs hold the rows of many ROOT files plus an index dataset of
+# the row range of every (run, file); their manifest records carry no checksum.
+shared_path = os.path.join(path, 'daya-data.h5')
+shard_path = os.path.join(path, 'shard-%05d.h5' % mpi_rank)
+shard = {} # The open shard file, its writer and index rows, created with the first file.
+
+def convert_to_shard(rootfile, joined=None, stages=None):
+    print rootfile, '->', shard_path
+    if not shard:
+        import h5py
+        shard['file'] = h5py.File(shard_path + '.tmp', 'w')
+        # the rows of a shard are not known up front, so no expected_rows: the datasets grow in the profile's full chunks
+        shard['writer'] = h5tools.H5StreamWriter(shard['file'], convert_background.OUTPUT_COLUMNS, expected_rows=0,
+                                                 profile=h5tools.PROFILES[args.profile])
+        shard['index'] = []
+        shard['size'] = 0
+    writer = shard['writer']
+    start = len(writer)
+    file_manifest.started(rootfile, shard_path)
+    t1 = time.time()
+    file_timings.begin_file(rootfile)
+    if stages:
+        file_timings.merge(stages)
+    try:
+        readout_entries, stats_entries = joined if joined is not None else convert_background.join_file(rootfile, file_timings)
+        convert_background.write_rows(rootfile, writer, readout_entries, stats_entries, ibd_index, args.workers, file_timings, args.pipeline)
+        # flush this file's rows so the shard's growth is what they took on disk
+        with file_timings.stage('write'):
+            writer.flush()
+            shard['file'].flush()
+        size = os.path.getsize(shard_path + '.tmp')
+        file_timings.add('write', 0, bytes_written=size - shard['size'])
+        shard['size'] = size
+    except Exception:
+        traceback.print_exc()
+        writer.truncate(start) # rows of a failed file stay out of the shard
+        file_manifest.failed(rootfile, shard_path, traceback.format_exc().splitlines()[-1], time.time() - t1)
+        file_timings.end_file('failed')
+        file_timings.save(timings_dir)
+        return
+    shard['index'].append(convert_background.index_row(rootfile, start, len(writer)))
+    file_manifest.done(rootfile, shard_path, len(writer) - start, time.time() - t1, checksum=False)
+    file_timings.end_file()
+    file_timings.save(timings_dir)
+
+def close_shard():
+    if not shard:
+        return
+    shard['writer'].close()
+    convert_background.write_index(shard['file'], shard['index'])
+    shard['file'].close()
+    os.rename(shard_path + '.tmp', shard_path)
+    os.chown(shard_path,61228,70018)
+
+def write_shared():
+    '''
+    Every rank joins its round-robin share of the files, the row counts are
+    summed over the ranks to give each file a fixed row range, and each rank
+    then converts its files straight into those ranges of one file opened
+    with the mpio driver. Datasets are contiguous, so the compression of the
+    profile is not applied. Failed files leave zero rows that the index skips.
+    '''
+    comm = MPI.COMM_WORLD
+    profile = h5tools.PROFILES[args.profile]
+    joined = {}
+    for file_idx in mpitools.static_indices(mpi_rank, nproc, end):
+        rootfile = str(content[file_idx])
+        file_manifest.started(rootfile, shared_path)
+        file_timings.begin_file(rootfile)
+        try:
+            entries = convert_background.join_file(rootfile, file_timings)
+        except Exception:
+            traceback.print_exc()
+            file_manifest.failed(rootfile, shared_path, traceback.format_exc().splitlines()[-1], time.time() - file_timings.current['start'])
+            file_timings.end_file('failed')
+            continue
+        joined[file_idx] = (entries, file_timings.current)
+        file_timings.current = None # finished after the write phase
+    counts = np.zeros(end, dtype='int64')
+    for file_idx, (entries, rec) in joined.iteritems():
+        counts[file_idx] = len(entries[0])
+    comm.Allreduce(MPI.IN_PLACE, counts, op=MPI.SUM)
+    stops = np.cumsum(counts)
+    starts = stops - counts
+
+    h5f = h5tools.open_parallel(shared_path + '.tmp', comm)
+    for name, (shape, dtype) in sorted(convert_background.OUTPUT_COLUMNS.iteritems()):
+        h5f.create_dataset(name, (int(stops[-1]) if end else 0,) + tuple(shape), dtype=profile.column_dtype(dtype))
+    written = np.zeros(end, dtype='int8')
+    for file_idx in sorted(joined):
+        rootfile = str(content[file_idx])
+        (readout_entries, stats_entries), file_timings.current = joined.pop(file_idx)
+        writer = h5tools.H5StreamWriter(h5f, convert_background.OUTPUT_COLUMNS, start=int(starts[file_idx]), profile=profile)
+        try:
+            convert_background.write_rows(rootfile, writer, readout_entries, stats_entries, ibd_index, args.workers, file_timings, args.pipeline)
+            with file_timings.stage('write'):
+                nrows = writer.close()
+            # contiguous and uncompressed, so the rows take exactly their size in the file
+            file_timings.add('write', 0, bytes_written=nrows * writer.row_nbytes)
+        except Exception:
+            traceback.print_exc()
+            file_manifest.failed(rootfile, shared_path, traceback.format_exc().splitlines()[-1], time.time() - file_timings.current['start'])
+            file_timings.end_file('failed')
+            continue
+        written[file_idx] = 1
+        file_manifest.done(rootfile, shared_path, nrows, time.time() - file_timings.current['start'], checksum=False)
+        file_timings.end_file()
+    file_timings.save(timings_dir)
+    comm.Allreduce(MPI.IN_PLACE, written, op=MPI.SUM)
+    # collective: every rank creates the index with the same records
+    convert_background.write_index(h5f, [convert_background.index_row(str(content[i]), starts[i], stops[i])
+                                         for i in xrange(end) if written[i]])
+    h5f.close()
+    if mpi_rank == 0:
+        os.rename(shared_path + '.tmp', shared_path)
+        os.chown(shared_path,61228,70018)
+
+
+# In[117]:
+
+if args.output == 'shared':
+    write_shared()
+else:
+    # under MPI with more than one rank, rank 0 only dispatches and converts nothing
+    dispatcher = args.schedule == 'dynamic' and args.nproc is None and nproc > 1 and mpi_rank == 0
+    if args.schedule == 'dynamic' and args.nproc is None:
+        # rank 0 hands out the next file, largest first, whenever a rank is free
+        order = [i for i in mpitools.largest_first(MPI.COMM_WORLD, content) if content[i] not in completed]
+        file_indices = mpitools.dynamic_indices(MPI.COMM_WORLD, order)
+    else:
+        file_indices = mpitools.static_indices(file_start_idx, nproc, end)
+    convert = convert_to_shard if args.output == 'shards' else convert_file
+    rootfiles = (str(content[file_idx]) for file_idx in file_indices)
+    if args.prefetch:
+        # the next file is taken from the schedule and joined while this one is converted, never more than one ahead
+        prefetch = pipeline.Prefetch((rootfile for rootfile in rootfiles if wanted(rootfile)),
+                                     join_ahead, name='join', sink_name='convert', source_name='claim')
+        for rootfile, joined, stages in prefetch:
+            convert(rootfile, joined, stages)
+        if not dispatcher:
+            pipeline.print_report(prefetch.report())
+    else:
+        for rootfile in rootfiles:
+            if wanted(rootfile):
+                convert(rootfile)
+    close_shard()
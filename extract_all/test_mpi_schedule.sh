@@ -0,0 +1,5 @@
+#!/bin/sh
+# Check the dynamic file scheduler with several ranks on one machine.
+# usage: ./test_mpi_schedule.sh [nranks]
+cd "$(dirname "$0")/.."
+mpiexec -n ${1:-4} python mpitools.py
@@ -7,6 +7,7 @@ import os
 import sys
 from collections import defaultdict
 import roottools
+import h5tools
 import array
 import numpy as np
 import itertools
@@ -35,6 +36,7 @@ NPIXELS = 192
 NCHANNELS = 4
 NMETADATA = len(METADATA_NAMES)
 ENTRYSIZE = NMETADATA + NCHANNELS * NPIXELS
+BATCH_SIZE = 1000 # Entries read from tr_ibd at a time.
 
 def main():
     
@@ -46,7 +48,6 @@ def main():
     start = Nstart * N
     stop = start + N 
     outfilename = 'ibd_yasu_%d_%d.h5' % (start, stop-1)
-    data = np.zeros((N, ENTRYSIZE), dtype='float32')
     # find starting value
     global_index = 0
     startfile = None
@@ -66,6 +67,11 @@ def main():
     if startfile is None:
         logging.error("Could not reach %dth event", start)
         return
+    outfile = h5py.File(outfilename, 'w')
+    # See benchmarks/bench_h5_profiles.py for the size/speed trade-offs
+    writer = h5tools.H5StreamWriter(outfile,
+        {'ibd_pair_data': ((ENTRYSIZE,), 'float32')},
+        expected_rows=N, profile=h5tools.PROFILES['float32-gzip'])
     # Go through the starting file
     intbranches = ['runno', 'fileno', 'site', 'det', 'time_sec',
         'time_nanosec', 'trigno_prompt', 'trigno_delayed',
@@ -80,11 +86,9 @@ def main():
         floatbranches, ivectorbranches, fvectorbranches)
     global_index = start  # refers to global index over all files
     endentry = min(roottree.numEntries(), startentry+N)
-    for entrynum in range(startentry, endentry):
-        roottree.loadentry(entrynum)
-        event = roottree.current
-        data[global_index-start] = getFlattenedData(event)
-        global_index += 1
+    for batch in roottree.iter_batches(BATCH_SIZE, start=startentry, stop=endentry):
+        writer.append({'ibd_pair_data': getFlattenedData(batch)})
+        global_index += len(batch)
     remainingEntries = stop - global_index
     fileindex = startfileindex + 1
     while remainingEntries > 0 and fileindex < len(filelist):
@@ -96,17 +100,14 @@ def main():
             ivectorbranches, fvectorbranches)
         startentry = 0
         endentry = min(roottree.numEntries(), remainingEntries)
-        for entrynum in range(startentry, endentry):
-            roottree.loadentry(entrynum)
-            event = roottree.current
-            data[global_index-start] = getFlattenedData(event)
-            global_index += 1
+        for batch in roottree.iter_batches(BATCH_SIZE, start=startentry, stop=endentry):
+            writer.append({'ibd_pair_data': getFlattenedData(batch)})
+            global_index += len(batch)
         remainingEntries = stop - global_index
         fileindex += 1
-    outfile = h5py.File(outfilename, 'w')
-    # TODO determine if chunks/compression is necessary
-    outdset = outfile.create_dataset("ibd_pair_data", data=data,
-        compression="gzip", chunks=True)
+    # Trims the dataset if the file list ran out before N entries
+    writer.close()
+    outdset = outfile['ibd_pair_data']
     # Set attributes so future generations can read this dataset
     outdset.attrs['description'] = \
 """This dataset contains pairs of IBD candidates (prompt, delayed) as
@@ -139,28 +140,18 @@ triggers and to the last muon.""" % (ENTRYSIZE, NPIXELS-1, NPIXELS,
     outfile.close()
     return
 
-def getFlattenedData(event):
-    event['nHitsAD'] = event['nHitsAD_prompt']
-    event['chargeAD'] = event['chargeAD_prompt']
-    event['timeAD'] = event['timeAD_prompt']
-    event['ring'] = event['ring_prompt']
-    event['column'] = event['column_prompt']
-    charge2d_prompt, time2d_prompt = roottools.getChargesTime(event)
-    event['nHitsAD'] = event['nHitsAD_delayed']
-    event['chargeAD'] = event['chargeAD_delayed']
-    event['timeAD'] = event['timeAD_delayed']
-    event['ring'] = event['ring_delayed']
-    event['column'] = event['column_delayed']
-    charge2d_delayed, time2d_delayed = roottools.getChargesTime(event)
-    # Reshape everything into one long vector
-    flatteneds = [
-        # reshape(-1) produces a 1D array
-        charge2d_prompt.reshape(-1),
-        time2d_prompt.reshape(-1),
-        charge2d_delayed.reshape(-1),
-        time2d_delayed.reshape(-1),
-        np.array([event[name] for name in METADATA_NAMES])
-    ]
+def getFlattenedData(batch):
+    """Flatten the prompt and delayed images plus the metadata of every
+    entry in a Batch into rows of length ENTRYSIZE."""
+    flatteneds = []
+    for suffix in ('_prompt', '_delayed'):
+        hits = dict((name, batch[name + suffix]) for name in
+            ('nHitsAD', 'chargeAD', 'timeAD', 'ring', 'column'))
+        charge2d, time2d = roottools.getChargesTimeBatch(hits)
+        # Reshape everything into one long vector per entry
+        flatteneds.append(charge2d.reshape((len(batch), -1)))
+        flatteneds.append(time2d.reshape((len(batch), -1)))
+    flatteneds.append(np.column_stack([batch[name] for name in METADATA_NAMES]))
     return np.hstack(flatteneds)
 
 def unflattenData(datavec):
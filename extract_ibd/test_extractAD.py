@@ -28,33 +28,35 @@ def main():
     Nstart = int( sys.argv[1]) 
     N = 10000 if len(sys.argv)== 2 else int(sys.argv[2])  # 10k events per file 
     start = Nstart * N
-    stop = start + N 
     outfile = 'ibd_v4_time_%d.h5' % start
     data = np.zeros((N, NFEATURES), dtype='f4')
-    i = -1
+    # Candidates whose file is known and readable, in list order.
+    rows = []
+    readable = {}
     for j,trigger in X.iterrows():
-        logging.debug('Start of loop')
         if (trigger['RunNo'], trigger['FileNo']) not in fdict:
             logging.info('Could not find run %d file %d',trigger['RunNo'], trigger['FileNo'])
             continue
         fn = fdict[(trigger['RunNo'], trigger['FileNo'])]
-        if not os.access(fn, os.R_OK):
+        if fn not in readable:
+            readable[fn] = os.access(fn, os.R_OK)
+        if not readable[fn]:
             logging.info('Could not read file %s', fn)
             continue
-        i += 1
-        if i < start:
-            continue
-        if i >= stop:
-            break # Early
-        try:
-            logging.debug(fn)
-            rval = extract_candidate(fn, [trigger['Detector']+1, trigger['Detector']+1], [trigger['trigno_prompt'], trigger['trigno_delayed']])
-        except:
-            logging.error('Error: Could not load trees from %s', fn)
-            i -= 1
-            continue
-        data1, data2 = rval[0], rval[1]
-        data[i - start, :] = np.hstack((trigger.values.reshape((1,-1)), data1, data2))
+        rows.append((j, fn))
+    # Fill N rows from candidate start on, in list order. Candidates that fail to
+    # extract are skipped, so keep taking more until N rows are filled.
+    pending = rows[start:]
+    i = 0
+    while i < N and pending:
+        chunk, pending = pending[:N - i], pending[N - i:]
+        rvals = extract_candidates(X, chunk)
+        for j, fn in chunk:
+            if j not in rvals:
+                continue
+            data1, data2 = rvals[j]
+            data[i, :] = np.hstack((X.loc[j].values.reshape((1,-1)), data1, data2))
+            i += 1
     if False:
         pkl.dump(data, outfile)     
     else:
@@ -65,28 +67,55 @@ def main():
         dset2[0:N, ...] = data[:, :11]
         f.close()
 
-def extract_candidate(filename, detectors, triggerNumbers):   
- 
-    treename = '/Event/CalibReadout/CalibReadoutHeader'
-    intbranches = ['nHitsAD','triggerNumber', 'detector']
-    floatbranches = []
-    ivectorbranches = ["ring","column","wallNumber"]
-    fvectorbranches = ["timeAD","chargeAD", "timePool", "chargePool", "wallSpot"]
-    t1 = roottools.RootTree(filename, treename, intbranches=intbranches, floatbranches=floatbranches, ivectorbranches=ivectorbranches, fvectorbranches=fvectorbranches)
- 
+def extract_candidates(X, rows):
+    '''
+    Extract prompt and delayed images for candidate rows [(label, filename)]
+    of X. Each file is opened once and all of its triggers are read in one
+    ordered pass. Returns a dict mapping label to (data1, data2) for the
+    candidates that could be extracted.
+    '''
+    byfile = defaultdict(list)
+    for j, fn in rows:
+        byfile[fn].append(j)
+    rvals = {}
+    for fn, labels in byfile.iteritems():
+        logging.debug(fn)
+        try:
+            t1 = roottools.makeCalibReadoutTree(fn)
+            t1.build_trigger_index(sidecar=True)
+        except:
+            logging.error('Error: Could not load trees from %s', fn)
+            continue
+        found = []
+        idxs = []
+        for j in labels:
+            trigger = X.loc[j]
+            try:
+                idxs += find_candidate(t1, [trigger['Detector']+1, trigger['Detector']+1], [trigger['trigno_prompt'], trigger['trigno_delayed']])
+            except:
+                logging.error('Error: Could not find triggers of row %s in %s', j, fn)
+                continue
+            found.append(j)
+        if not found:
+            continue
+        entries, inverse = np.unique(idxs, return_inverse=True)
+        batch = t1.read_entries(entries, ['nHitsAD', 'chargeAD', 'timeAD', 'ring', 'column'])
+        charges, times = roottools.getChargesTimeBatch(batch, preprocess_flag=True)
+        images = np.hstack((charges.reshape((len(entries), -1)), times.reshape((len(entries), -1))))
+        for k, j in enumerate(found):
+            rvals[j] = (images[inverse[2*k]].reshape((1, -1)), images[inverse[2*k+1]].reshape((1, -1)))
+    return rvals
+
+def find_candidate(t1, detectors, triggerNumbers):
+    '''Return the entry numbers of the triggers, each searched from the previous one.'''
     startidx = 0
-    rval = []
+    idxs = []
     for (detector, triggerNumber) in zip(detectors, triggerNumbers): 
         idx = t1.find_trigger(detector, triggerNumber, startidx)
-        assert idx is not None, filename
-        e1 = t1.loadentry(idx)
-        charge, time = roottools.getChargesTime(e1, preprocess_flag=True)
-        #isflasher = roottools.isflasher(e2)       
-        data = np.zeros((1,2*192), dtype='float32')
-        data[0, :] =  np.hstack((charge.flatten(),time.flatten()))
-        rval.append(data)
+        assert idx is not None, t1.filename
+        idxs.append(idx)
         startidx = idx
-    return rval
+    return idxs
 
 
 if __name__=='__main__':
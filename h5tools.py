@@ -0,0 +1,150 @@
+# Streaming HDF5 output for the converters
+import numpy as np
+
+DEFAULT_BUFFER_ROWS = 4096 # Rows held in memory per dataset before a flush.
+DEFAULT_CHUNK_ROWS = 256 # Rows per HDF5 chunk, about one training minibatch.
+
+class OutputProfile(object):
+    '''Precision and compression settings for converted datasets.
+
+       dtype replaces the dtype of floating point datasets (None keeps it),
+       compression is None, 'gzip' or 'lzf', shuffle enables the byte
+       shuffle filter and chunk_rows sets the rows per chunk.
+    '''
+    def __init__(self, dtype=None, compression=None, compression_opts=None, shuffle=False, chunk_rows=DEFAULT_CHUNK_ROWS):
+        self.dtype = dtype
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.shuffle = shuffle
+        self.chunk_rows = chunk_rows
+
+    def column_dtype(self, dtype):
+        if self.dtype is not None and np.issubdtype(np.dtype(dtype), np.floating):
+            return self.dtype
+        return dtype
+
+    def dataset_kwargs(self):
+        kwargs = {}
+        if self.compression is not None:
+            kwargs['compression'] = self.compression
+            if self.compression_opts is not None:
+                kwargs['compression_opts'] = self.compression_opts
+        if self.shuffle:
+            kwargs['shuffle'] = True
+        return kwargs
+
+# float16 keeps about 3 significant digits and overflows above 65504.
+PROFILES = {
+    'float64': OutputProfile(),
+    'float32': OutputProfile(dtype='float32'),
+    'float32-gzip': OutputProfile(dtype='float32', compression='gzip', compression_opts=4, shuffle=True),
+    'float32-lzf': OutputProfile(dtype='float32', compression='lzf', shuffle=True),
+    'float16-gzip': OutputProfile(dtype='float16', compression='gzip', compression_opts=4, shuffle=True),
+}
+
+class H5StreamWriter(object):
+    '''Append rows to chunked HDF5 datasets through a bounded buffer.
+
+       columns maps a dataset name to (row shape, dtype). Missing datasets
+       are created resizable (sized to expected_rows if given) and trimmed to
+       the number of rows written on close(). Datasets that already exist in
+       the group are filled in place from row start, e.g. one class block of
+       a preallocated dataset. An OutputProfile sets the dtype, compression
+       and chunking of created datasets; extra keyword arguments go to
+       create_dataset.
+    '''
+    def __init__(self, group, columns, buffer_rows=DEFAULT_BUFFER_ROWS, start=0, expected_rows=0, profile=None, **dataset_kwargs):
+        if profile is None:
+            profile = PROFILES['float64']
+        self.group = group
+        self.buffer_rows = buffer_rows
+        self.start = start
+        self.nbuffered = 0 # Rows waiting in the buffers.
+        self.nflushed = 0 # Rows already written to the datasets.
+        self.buffers = {}
+        self.resizable = {}
+        for name, (shape, dtype) in columns.iteritems():
+            shape = tuple(shape)
+            dtype = profile.column_dtype(dtype)
+            if name not in group:
+                # without a size hint keep full chunks; a dataset known to be small gets one chunk
+                chunk_rows = min(profile.chunk_rows, expected_rows) if expected_rows > 0 else profile.chunk_rows
+                kwargs = {'chunks': (chunk_rows,) + shape}
+                kwargs.update(profile.dataset_kwargs())
+                kwargs.update(dataset_kwargs)
+                group.create_dataset(name, (expected_rows,) + shape, dtype=dtype,
+                                     maxshape=(None,) + shape, **kwargs)
+                self.resizable[name] = True
+            else:
+                self.resizable[name] = False
+                dtype = group[name].dtype
+            self.buffers[name] = np.zeros((buffer_rows,) + shape, dtype=dtype)
+        self.row_nbytes = sum(buf[0].nbytes for buf in self.buffers.itervalues()) # One row over all datasets, uncompressed.
+
+    def __len__(self):
+        return self.nflushed + self.nbuffered
+
+    def append(self, rows):
+        '''Append a dict of arrays with the same number of rows, one per dataset.'''
+        n = len(rows.itervalues().next())
+        done = 0
+        while done < n:
+            k = min(n - done, self.buffer_rows - self.nbuffered)
+            for name, buf in self.buffers.iteritems():
+                buf[self.nbuffered:self.nbuffered+k] = np.reshape(rows[name][done:done+k], (k,) + buf.shape[1:])
+            self.nbuffered += k
+            done += k
+            if self.nbuffered == self.buffer_rows:
+                self.flush()
+
+    def flush(self):
+        if self.nbuffered == 0:
+            return
+        lo = self.start + self.nflushed
+        hi = lo + self.nbuffered
+        for name, buf in self.buffers.iteritems():
+            dset = self.group[name]
+            if dset.shape[0] < hi:
+                if not self.resizable[name]:
+                    raise ValueError('Dataset %s has no room for rows %d-%d' % (name, lo, hi-1))
+                dset.resize(hi, axis=0)
+            dset[lo:hi] = buf[:self.nbuffered]
+        self.nflushed += self.nbuffered
+        self.nbuffered = 0
+
+    def truncate(self, nrows):
+        '''Drop every row after the first nrows, e.g. those of a source that failed half way.'''
+        if nrows >= self.nflushed:
+            self.nbuffered = min(self.nbuffered, nrows - self.nflushed)
+        else:
+            # rows already on disk are overwritten by the next flush or trimmed by close()
+            self.nbuffered = 0
+            self.nflushed = nrows
+
+    def close(self):
+        '''Flush the buffers, trim created datasets and return the number of rows written.'''
+        self.flush()
+        for name in self.buffers:
+            if self.resizable[name]:
+                self.group[name].resize(self.start + self.nflushed, axis=0)
+        self.buffers = {}
+        return self.nflushed
+
+def has_parallel():
+    ''' True if h5py was built with MPI, as open_parallel needs for more than one rank.'''
+    import h5py
+    return bool(h5py.get_config().mpi)
+
+def open_parallel(filename, comm):
+    '''
+    Create filename for writing by every rank of comm with the mpio driver.
+    Collective; a single rank opens it serially, so the same code runs
+    without parallel HDF5. Datasets of a parallel file should be created
+    contiguous (no chunks or filters) by all ranks with the same arguments.
+    '''
+    import h5py
+    if comm.Get_size() == 1:
+        return h5py.File(filename, 'w')
+    if not has_parallel():
+        raise RuntimeError('h5py was built without MPI; a shared output file needs parallel HDF5 (or use shards)')
+    return h5py.File(filename, 'w', driver='mpio', comm=comm)
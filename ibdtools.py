@@ -0,0 +1,92 @@
+# IBD candidate lookup for labelling converted events
+import os
+import numpy as np
+
+CACHE_SUFFIX = '.ibdidx.npy' # Memory-mapped cache of a candidate list, see load_ibd_index.
+
+def _key(run_no, file_no):
+    return (np.asarray(run_no, dtype='int64') << 32) | np.asarray(file_no, dtype='int64')
+
+class IBDIndex(object):
+    '''Prompt and delayed trigger numbers of IBD candidates keyed by (run, file).
+
+       Candidates are kept in arrays sorted by (run, file) and then by trigger
+       number, so a lookup is two binary searches and labelling a whole file
+       is one vectorized membership test.
+    '''
+    def __init__(self, run_no, file_no, trigno_prompt, trigno_delayed):
+        keys = _key(run_no, file_no)
+        trigno_prompt = np.asarray(trigno_prompt, dtype='int64')
+        trigno_delayed = np.asarray(trigno_delayed, dtype='int64')
+        prompt_order = np.lexsort((trigno_prompt, keys))
+        delayed_order = np.lexsort((trigno_delayed, keys))
+        self.keys = keys[prompt_order]
+        self.prompt = trigno_prompt[prompt_order]
+        self.delayed = trigno_delayed[delayed_order]
+
+    @staticmethod
+    def from_table(table):
+        ''' Wrap a (3, n) array from table() without copying it.'''
+        index = IBDIndex.__new__(IBDIndex)
+        index.keys, index.prompt, index.delayed = table
+        return index
+
+    def table(self):
+        ''' The sorted keys, prompt and delayed arrays stacked into one (3, n) int64 array.'''
+        return np.vstack([self.keys, self.prompt, self.delayed])
+
+    @staticmethod
+    def load(filename, mmap_mode='r'):
+        ''' Load an index saved with save(), memory-mapped by default.'''
+        return IBDIndex.from_table(np.load(filename, mmap_mode=mmap_mode))
+
+    def save(self, filename):
+        '''Write table() as .npy, renaming it into place when complete.'''
+        tmpname = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmpname, 'wb') as f:
+            np.save(f, self.table())
+        os.rename(tmpname, filename)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, run_no, file_no):
+        ''' Return sorted (prompt, delayed) trigger numbers for one file.'''
+        key = _key(run_no, file_no)
+        lo = np.searchsorted(self.keys, key, side='left')
+        hi = np.searchsorted(self.keys, key, side='right')
+        return self.prompt[lo:hi], self.delayed[lo:hi]
+
+    def select(self, run_no, file_no):
+        ''' Return an IBDIndex holding only the candidates of one file.'''
+        prompt, delayed = self.lookup(run_no, file_no)
+        n = len(prompt)
+        return IBDIndex(np.repeat(run_no, n), np.repeat(file_no, n), prompt, delayed)
+
+    def labels(self, trig_nos, run_no, file_no):
+        ''' Return boolean (is_prompt, is_delayed) arrays for the given triggers of one file.'''
+        prompt, delayed = self.lookup(run_no, file_no)
+        trig_nos = np.asarray(trig_nos, dtype='int64')
+        return np.in1d(trig_nos, prompt), np.in1d(trig_nos, delayed)
+
+def load_ibd_index(filename, cache=True):
+    '''
+    Build an IBDIndex from a tab separated candidate list such as
+    ibd_candidates_eh1.txt. With cache=True the index is memory-mapped from
+    filename + CACHE_SUFFIX when that is newer than the list, and written
+    there otherwise, so only the first task pays for parsing the text.
+    '''
+    cachename = filename + CACHE_SUFFIX
+    if cache and os.path.exists(cachename) and \
+       os.path.getmtime(cachename) >= os.path.getmtime(filename):
+        return IBDIndex.load(cachename)
+    import pandas
+    X = pandas.read_csv(filename, delimiter='\t')
+    index = IBDIndex(X['RunNo'].values, X['FileNo'].values,
+                     X['trigno_prompt'].values, X['trigno_delayed'].values)
+    if cache:
+        try:
+            index.save(cachename)
+        except (IOError, OSError):
+            pass # Read-only directory, parse the text every time.
+    return index
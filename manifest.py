@@ -0,0 +1,99 @@
+# Append-only record of which input files a conversion campaign has finished
+import os
+import glob
+import json
+import time
+import socket
+import hashlib
+
+STARTED = 'started'
+DONE = 'done'
+FAILED = 'failed'
+
+def file_checksum(filename, blocksize=1 << 20):
+    ''' md5 hex digest of a file, read in blocks.'''
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), ''):
+            md5.update(block)
+    return md5.hexdigest()
+
+class Manifest(object):
+    '''JSON-lines status log for one rank or array task.
+
+       Every rank appends to its own file rank-<rank>.jsonl in directory,
+       so no locking is needed. A record is written when a file is
+       started and again when it is done or failed; the last record of an
+       input wins when the manifests are read back with load_status.
+    '''
+    def __init__(self, directory, rank):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        self.rank = rank
+        self.filename = os.path.join(directory, 'rank-%05d.jsonl' % rank)
+
+    def record(self, input_file, status, **fields):
+        fields.update({'input': input_file, 'status': status, 'rank': self.rank,
+                       'host': socket.gethostname(), 'time': time.time()})
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(fields, sort_keys=True) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def started(self, input_file, output_file):
+        self.record(input_file, STARTED, output=output_file)
+
+    def done(self, input_file, output_file, rows, seconds, checksum=True):
+        ''' checksum=False skips the size and md5 of output_file, e.g. one shared by many inputs.'''
+        if not checksum:
+            self.record(input_file, DONE, output=output_file, rows=rows, seconds=seconds)
+            return
+        self.record(input_file, DONE, output=output_file, rows=rows, seconds=seconds,
+                    bytes=os.path.getsize(output_file), md5=file_checksum(output_file))
+
+    def failed(self, input_file, output_file, error, seconds):
+        self.record(input_file, FAILED, output=output_file, error=error, seconds=seconds)
+
+def load_status(directory):
+    ''' Return {input file: last record} over all manifests in directory.'''
+    status = {}
+    for filename in glob.glob(os.path.join(directory, 'rank-*.jsonl')):
+        with open(filename) as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue # Line cut short by a killed rank.
+                last = status.get(rec['input'])
+                if last is None or rec['time'] >= last['time']:
+                    status[rec['input']] = rec
+    return status
+
+def completed(directory):
+    '''
+    Return the set of input files whose last record is done and whose
+    output still exists with the recorded size. Inputs done into a shared
+    output (no recorded size) are not included.
+    '''
+    done = set()
+    for input_file, rec in load_status(directory).iteritems():
+        if rec['status'] != DONE:
+            continue
+        if 'bytes' in rec and os.path.exists(rec['output']) and os.path.getsize(rec['output']) == rec['bytes']:
+            done.add(input_file)
+    return done
+
+if __name__ == '__main__':
+    # Summarize a manifest directory: python manifest.py <directory>
+    import sys
+    status = load_status(sys.argv[1])
+    counts = {}
+    for rec in status.itervalues():
+        counts[rec['status']] = counts.get(rec['status'], 0) + 1
+    print "%d inputs: %s" % (len(status), ', '.join('%d %s' % (n, s) for s, n in sorted(counts.iteritems())))
+    for input_file, rec in sorted(status.iteritems()):
+        if rec['status'] == FAILED:
+            print "failed on rank %d (%s): %s\n    %s" % (rec['rank'], rec['host'], input_file, rec['error'])
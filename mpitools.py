@@ -0,0 +1,147 @@
+# MPI helpers for distributing converter work over ranks
+import os
+import numpy as np
+
+def static_indices(rank, nproc, n):
+    ''' Round-robin share of range(n) for one rank.'''
+    return range(rank, n, nproc)
+
+def largest_first(comm, filenames):
+    '''
+    Return the indices of filenames ordered by file size, largest first.
+    Only rank 0 touches the filesystem; missing files count as empty.
+    '''
+    order = None
+    if comm.Get_rank() == 0:
+        sizes = [os.path.getsize(fn) if os.path.exists(fn) else 0 for fn in filenames]
+        order = [int(i) for i in np.argsort(sizes, kind='mergesort')[::-1]]
+    return comm.bcast(order, root=0)
+
+WORK_TAG = 11 # Message tag for work requests and replies.
+
+def dynamic_indices(comm, order):
+    '''
+    Hand out items of order from rank 0 to the other ranks as they ask for
+    work, so a rank that finishes early picks up more. Rank 0 only
+    dispatches and yields nothing; with a single rank every item is yielded
+    locally. Collective: every rank of comm must exhaust the generator.
+    '''
+    from mpi4py import MPI
+    order = list(order)
+    if comm.Get_size() == 1:
+        for item in order:
+            yield item
+        return
+    if comm.Get_rank() == 0:
+        status = MPI.Status()
+        # One None per worker tells it there is nothing left.
+        for item in order + [None] * (comm.Get_size() - 1):
+            comm.recv(source=MPI.ANY_SOURCE, tag=WORK_TAG, status=status)
+            comm.send(item, dest=status.Get_source(), tag=WORK_TAG)
+        return
+    while True:
+        comm.send(None, dest=0, tag=WORK_TAG)
+        item = comm.recv(source=0, tag=WORK_TAG)
+        if item is None:
+            return
+        yield item
+
+def bcast_array(comm, arr, root=0):
+    '''
+    Broadcast a numpy array from root as raw bytes; arr is ignored on the
+    other ranks. One small pickled header plus one Bcast of the data.
+    '''
+    header = None
+    if comm.Get_rank() == root:
+        arr = np.ascontiguousarray(arr)
+        header = (arr.shape, arr.dtype.str)
+    shape, dtype = comm.bcast(header, root=root)
+    if comm.Get_rank() != root:
+        arr = np.empty(shape, dtype=dtype)
+    comm.Bcast(arr.reshape(-1).view('uint8'), root=root)
+    return arr
+
+_windows = [] # Shared windows stay allocated as long as their arrays are in use.
+
+def shared_array(comm, arr, root=0):
+    '''
+    Give every rank a read-only copy of a numpy array from root, stored
+    once per node in an MPI-3 shared memory window. Only one rank per node
+    receives the data over the network. Falls back to bcast_array when the
+    MPI library has no shared windows. Collective over comm.
+    '''
+    from mpi4py import MPI
+    try:
+        node = comm.Split_type(MPI.COMM_TYPE_SHARED)
+    except (AttributeError, NotImplementedError, MPI.Exception):
+        return bcast_array(comm, arr, root)
+    header = None
+    if comm.Get_rank() == root:
+        arr = np.ascontiguousarray(arr)
+        header = (arr.shape, arr.dtype.str)
+    shape, dtype = comm.bcast(header, root=root)
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    # root owns the window on its node, the lowest rank on every other node
+    isroot = comm.Get_rank() == root
+    owner = node.allreduce(isroot, op=MPI.LOR)
+    leader = isroot if owner else node.Get_rank() == 0
+    win = MPI.Win.Allocate_shared(max(nbytes, 1) if leader else 0, 1, comm=node)
+    buf, itemsize = win.Shared_query(node.allreduce(node.Get_rank() if leader else 0, op=MPI.MAX))
+    shared = np.ndarray(buffer=buf, dtype='uint8', shape=(max(nbytes, 1),))[:nbytes]
+    leaders = comm.Split(0 if leader else MPI.UNDEFINED, 0 if isroot else 1)
+    if leader:
+        if isroot:
+            shared[:] = arr.reshape(-1).view('uint8')
+        leaders.Bcast(shared, root=0) # root is rank 0 of leaders by the split key
+        leaders.Free()
+    node.Barrier()
+    _windows.append(win)
+    result = shared.view(dtype).reshape(shape)
+    result.flags.writeable = False
+    return result
+
+if __name__ == '__main__':
+    # Self-check: mpiexec -n 4 python mpitools.py
+    import time
+    from mpi4py import MPI
+    comm = MPI.COMM_WORLD
+    rng = np.random.RandomState(comm.Get_rank())
+    n = 200
+    mine = []
+    for i in dynamic_indices(comm, range(n)):
+        time.sleep(rng.uniform(0, 0.01) * (comm.Get_rank() + 1)) # Uneven work per rank
+        mine.append(i)
+    claimed = comm.gather(mine, root=0)
+    if comm.Get_rank() == 0:
+        allclaimed = sorted(sum(claimed, []))
+        assert allclaimed == range(n), 'Work items lost or handed out twice'
+        print "dynamic_indices ok: %d items over %d ranks, per rank %s" % (n, comm.Get_size(), [len(c) for c in claimed])
+    # a prefetching rank claims at most one item ahead of the one it works on
+    import pipeline
+    comm.Barrier() # workers must not ask for items while rank 0 still dispatches the first round
+    claims = [0]
+    def claimed_items():
+        for i in dynamic_indices(comm, range(n)):
+            claims[0] += 1
+            yield i
+    done = 0
+    worst = 0
+    for i in pipeline.Prefetch(claimed_items(), lambda i: i):
+        time.sleep(0.002)
+        worst = max(worst, claims[0] - done)
+        done += 1
+    worst = comm.gather(worst, root=0)
+    if comm.Get_rank() == 0:
+        assert max(worst) <= 2, 'Prefetch claimed %d items ahead' % (max(worst) - 1)
+        print "Prefetch ok: at most %d item claimed ahead" % (max(worst) - 1)
+    expected = np.arange(30, dtype='int64').reshape((3, 10)) * 7
+    names = np.array(['recon.a.root', 'recon.bb.root'])
+    for share in (bcast_array, shared_array):
+        got = share(comm, expected if comm.Get_rank() == 0 else None)
+        assert got.dtype == expected.dtype and np.array_equal(got, expected), '%s lost data' % share.__name__
+        got = share(comm, names if comm.Get_rank() == 0 else None)
+        assert list(got) == list(names), '%s lost strings' % share.__name__
+    comm.Barrier()
+    if comm.Get_rank() == 0:
+        print "bcast_array and shared_array ok"
@@ -0,0 +1,216 @@
+# Threaded stages connected by bounded queues, with per-stage utilization
+import sys
+import time
+import threading
+import Queue
+
+DEFAULT_DEPTH = 2 # Items a stage may run ahead of the next one.
+_END = object() # Marks the end of a queue.
+
+class StageStats(object):
+    '''Busy, starved and blocked seconds of one stage, and the depth of its output queue.'''
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0 # Running the stage function or pulling the source.
+        self.starved = 0.0 # Waiting for an item from the previous stage.
+        self.blocked = 0.0 # Waiting for room in the output queue.
+        self.depth_sum = 0 # Output queue depth seen at every put, for the mean.
+        self.depth_max = 0
+
+    def as_dict(self, elapsed):
+        return {'items': self.items, 'busy': self.busy, 'starved': self.starved, 'blocked': self.blocked,
+                'utilization': self.busy / elapsed if elapsed > 0 else 0.,
+                'mean_depth': float(self.depth_sum) / self.items if self.items else 0.,
+                'max_depth': self.depth_max}
+
+class Pipeline(object):
+    '''Overlap the stages of a stream on threads.
+
+       The source iterable is pulled on its own thread (stage source_name)
+       and every (name, func) of stages runs on its own thread, each
+       feeding the next through a queue of at most depth items. Iterating
+       the pipeline yields the results of the last stage in source order;
+       the consumer's own time between items is reported as stage sink_name.
+       An exception on any thread is raised again in the consumer. Stages
+       only overlap where they release the GIL, as numpy copies and the
+       zlib/lz4 decompression under uproot do. PyROOT calls and h5py 2.x
+       hold it throughout, so a PyROOT read or an h5py write stage overlaps
+       little with the others.
+    '''
+    def __init__(self, source, stages, depth=DEFAULT_DEPTH, source_name='read', sink_name='sink'):
+        self.source = source
+        self.stages = list(stages)
+        self.depth = depth
+        self.stats = [StageStats(source_name)] + [StageStats(name) for name, func in self.stages] + [StageStats(sink_name)]
+        self.elapsed = 0.0
+        self._stop = threading.Event()
+        self._error = None
+
+    def _put(self, queue, item, stats):
+        t0 = time.time()
+        while not self._stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                break
+            except Queue.Full:
+                continue
+        stats.blocked += time.time() - t0
+        if item is not _END:
+            depth = queue.qsize()
+            stats.depth_sum += depth
+            stats.depth_max = max(stats.depth_max, depth)
+
+    def _get(self, queue, stats):
+        t0 = time.time()
+        while not self._stop.is_set():
+            try:
+                item = queue.get(timeout=0.1)
+                break
+            except Queue.Empty:
+                continue
+        else:
+            item = _END
+        stats.starved += time.time() - t0
+        return item
+
+    def _run_source(self, out, stats):
+        try:
+            items = iter(self.source)
+            while not self._stop.is_set():
+                t0 = time.time()
+                item = next(items, _END)
+                stats.busy += time.time() - t0
+                if item is _END:
+                    break
+                stats.items += 1
+                self._put(out, item, stats)
+        except Exception:
+            self._fail()
+        self._put(out, _END, stats)
+
+    def _run_stage(self, func, inp, out, stats):
+        try:
+            while True:
+                item = self._get(inp, stats)
+                if item is _END:
+                    break
+                t0 = time.time()
+                item = func(item)
+                stats.busy += time.time() - t0
+                stats.items += 1
+                self._put(out, item, stats)
+        except Exception:
+            self._fail()
+        self._put(out, _END, stats)
+
+    def _fail(self):
+        if self._error is None:
+            self._error = sys.exc_info()
+        self._stop.set()
+
+    def __iter__(self):
+        queues = [Queue.Queue(self.depth) for i in xrange(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._run_source, args=(queues[0], self.stats[0]))]
+        for i, (name, func) in enumerate(self.stages):
+            threads.append(threading.Thread(target=self._run_stage, args=(func, queues[i], queues[i+1], self.stats[i+1])))
+        sink = self.stats[-1]
+        t0 = time.time()
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            while True:
+                item = self._get(queues[-1], sink)
+                if item is _END:
+                    break
+                t1 = time.time()
+                yield item
+                sink.busy += time.time() - t1
+                sink.items += 1
+        finally:
+            # also reached when the consumer stops early
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+            self.elapsed = time.time() - t0
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+
+    def report(self):
+        ''' {stage: stats} of the last run; utilization is busy time over the pipeline's wall time.'''
+        return dict((stats.name, stats.as_dict(self.elapsed)) for stats in self.stats)
+
+class Prefetch(object):
+    '''Run func on the next item of source on a thread while the consumer handles the current one.
+
+       Unlike Pipeline, the next item is only pulled from source once the
+       consumer has taken the previous result, so exactly one item is in
+       flight ahead of the one being consumed; use it when pulling an item
+       claims work, e.g. from the dynamic MPI scheduler. Iterating yields
+       func(item) in source order; errors are raised in the consumer.
+       report() is as for Pipeline, with stages source_name (pulling the
+       source, e.g. waiting for the scheduler), name and sink_name.
+    '''
+    def __init__(self, source, func, name='prefetch', sink_name='sink', source_name='source'):
+        self.source = source
+        self.func = func
+        self.stats = [StageStats(source_name), StageStats(name), StageStats(sink_name)]
+        self.elapsed = 0.0
+
+    def _step(self, items, box):
+        pull, stats = self.stats[:2]
+        try:
+            t0 = time.time()
+            item = next(items, _END)
+            t1 = time.time()
+            pull.busy += t1 - t0
+            if item is not _END:
+                pull.items += 1
+                item = self.func(item)
+                stats.busy += time.time() - t1
+                stats.items += 1
+            box['item'] = item
+        except Exception:
+            box['error'] = sys.exc_info()
+
+    def _start(self, items):
+        box = {}
+        thread = threading.Thread(target=self._step, args=(items, box))
+        thread.daemon = True
+        thread.start()
+        return thread, box
+
+    def __iter__(self):
+        items = iter(self.source)
+        sink = self.stats[-1]
+        t0 = time.time()
+        thread, box = self._start(items)
+        try:
+            while True:
+                t1 = time.time()
+                thread.join()
+                sink.starved += time.time() - t1
+                if 'error' in box:
+                    raise box['error'][0], box['error'][1], box['error'][2]
+                item = box['item']
+                if item is _END:
+                    break
+                # only now is the next item claimed, while this one is consumed
+                thread, box = self._start(items)
+                t1 = time.time()
+                yield item
+                sink.busy += time.time() - t1
+                sink.items += 1
+        finally:
+            thread.join() # a step in flight cannot be cancelled
+            self.elapsed = time.time() - t0
+
+    def report(self):
+        return dict((stats.name, stats.as_dict(self.elapsed)) for stats in self.stats)
+
+def print_report(report):
+    print "%-10s %8s %8s %8s %8s %6s %7s %5s" % ('stage', 'items', 'busy s', 'starved', 'blocked', 'util', 'mean q', 'max q')
+    for name, s in sorted(report.iteritems(), key=lambda kv: -kv[1]['busy']):
+        print "%-10s %8d %8.2f %8.2f %8.2f %5.0f%% %7.2f %5d" % (name, s['items'], s['busy'], s['starved'], s['blocked'],
+              100 * s['utilization'], s['mean_depth'], s['max_depth'])
@@ -1,94 +1,576 @@
 # roottools by peter sadowski
-import ROOT
+import os
 import array
+import socket
 import numpy as np
 import itertools
+import collections
+import columncache
+
+TRIGGER_INDEX_SUFFIX = '.trigidx.npz' # Sidecar file for RootTree.build_trigger_index.
+# Reader used by RootTree: 'uproot', 'pyroot' or 'auto' (uproot when it is installed).
+DEFAULT_BACKEND = os.environ.get('ROOTTOOLS_BACKEND', 'auto')
 
 class RootTree():
-    def __init__(self,filename, treename, intbranches=[], floatbranches=[],ivectorbranches=[],fvectorbranches=[]):
-        ch = ROOT.TChain(treename)
-        status = ch.Add(filename)
-        #if status == 1:
-        #    raise ValueError('Error: File %s does not have tree %s' % (filename, treename))
-        branchPointers = {}
-        branchDict = {}
-        ch.SetMakeClass(1)
-        for branchname in intbranches:
-            branchPointers[branchname] = array.array('I', [0])
-        for branchname in floatbranches:
-            branchPointers[branchname] = array.array('f', [0])
-        for branchname in fvectorbranches:
-            branchPointers[branchname] = ROOT.std.vector('float')() 
-        for branchname in ivectorbranches:
-            branchPointers[branchname] = ROOT.std.vector('int')() 
-       
-        branches = intbranches + floatbranches + ivectorbranches + fvectorbranches
-        ch.SetBranchStatus("*",0)
-        [ ch.SetBranchStatus(branchname, 1) for branchname in branches ]
-        for branchname in branches:
-            branchDict[branchname] = ch.GetBranch(branchname)
-            ch.SetBranchAddress(branchname, branchPointers[branchname])
-        #return ch, branchDict, branchPointers, branches
+    def __init__(self,filename, treename, intbranches=[], floatbranches=[],ivectorbranches=[],fvectorbranches=[], backend=None, cache=None):
         self.filename = filename
         self.treename = treename
-        self.ch = ch
-        self.branchDict = branchDict
-        self.branchPointers = branchPointers
-        self.branches = branches
+        self.branches = intbranches + floatbranches + ivectorbranches + fvectorbranches
         self.intbranches = intbranches
         self.floatbranches = floatbranches
         self.fvectorbranches = fvectorbranches
         self.ivectorbranches = ivectorbranches
+        # Where an Entry keeps each branch: (kind, index in its kind's storage, index of its loaded flag).
+        self.slots = {}
+        for kind, names in [(_INT, intbranches), (_FLOAT, floatbranches), (_VECTOR, ivectorbranches + fvectorbranches)]:
+            for j, branchname in enumerate(names):
+                self.slots[branchname] = (kind, j, len(self.slots))
+        self.reader = make_reader(self, backend, cache)
         self.current = {} # Dict containing data for current entry.
+        self.generation = 0 # Number of loadentry calls, so an Entry knows when it is no longer current.
+        self.trigger_index = None # TriggerIndex used by find_trigger once built.
 
     def loadentry(self, i):
-        self.ch.LoadTree(i)
-        self.ch.GetEntry(i)
+        self.reader.load(i)
+        self.generation += 1
         self.current = Entry(self, True)
         return self.current
      
     def getentries(self):
         ''' Return generator for all sequential entries.'''
-        nEntries= self.ch.GetEntries()
+        nEntries= self.numEntries()
         for i in xrange(nEntries):
             if i%1000==0:
                 print "Processing event nr. %i of %i" % (i,nEntries)
             current = self.loadentry(i)
             yield current
     def numEntries(self):
-        return self.ch.GetEntries()
-        
-    
+        return self.reader.num_entries()
+
+    def read_entries(self, entries, branches=None):
+        '''
+        Read the given entry numbers into a Batch of numpy columns.
+        Scalar branches become 1D arrays, vector branches become JaggedArrays.
+        Only the requested branches are read from disk.
+        '''
+        if branches is None:
+            branches = self.branches
+        for branchname in branches:
+            if branchname not in self.branches:
+                raise KeyError('Branch %s is not enabled on tree %s' % (branchname, self.treename))
+        entries = np.asarray(entries, dtype='int64')
+        return Batch(self.reader.read(entries, branches), entries)
+
+    def read_columns(self, branches=None):
+        '''Read whole columns of the tree into a Batch.'''
+        return self.read_entries(np.arange(self.numEntries()), branches)
+
+    def iter_batches(self, batch_size=10000, branches=None, start=0, stop=None):
+        ''' Return generator of Batches of at most batch_size sequential entries.'''
+        if stop is None:
+            stop = self.numEntries()
+        for i in xrange(start, stop, batch_size):
+            yield self.read_entries(np.arange(i, min(i + batch_size, stop)), branches)
+
+    def _column_dtype(self, branchname):
+        ''' dtype of the Batch column of a branch.'''
+        if branchname in self.intbranches:
+            return 'uint32'
+        if branchname in self.ivectorbranches:
+            return 'int32'
+        return 'float32'
+
+    def close(self):
+        ''' Release what the reader holds beyond the tree itself, i.e. mapped cache columns.'''
+        if isinstance(self.reader, CachedReader):
+            self.reader.close()
+
+    def cache_branches(self, branches=None):
+        '''
+        Store the given branches (default: all) in the column cache now if
+        the tree reads through one, e.g. once before worker processes each
+        read part of the file. Returns whether they are cached.
+        '''
+        if not isinstance(self.reader, CachedReader):
+            return False
+        return self.reader.prefill(self.branches if branches is None else branches)
+
+    def build_trigger_index(self, sidecar=False):
+        '''
+        Build the (detector, triggerNumber) -> entry index used by find_trigger
+        from one bulk read of both columns. With sidecar=True the index is
+        loaded from / saved to filename + TRIGGER_INDEX_SUFFIX when possible.
+        '''
+        sidecarname = self.filename + TRIGGER_INDEX_SUFFIX
+        if sidecar and os.path.exists(sidecarname) and \
+           os.path.getmtime(sidecarname) >= os.path.getmtime(self.filename):
+            self.trigger_index = TriggerIndex.load(sidecarname)
+            return self.trigger_index
+        columns = self.read_columns(['detector', 'triggerNumber'])
+        self.trigger_index = TriggerIndex(columns['detector'], columns['triggerNumber'], columns.entries)
+        if sidecar:
+            try:
+                self.trigger_index.save(sidecarname)
+            except (IOError, OSError):
+                pass # Read-only data directory, keep the index in memory only.
+        return self.trigger_index
+
     def find_trigger(self, detector, triggerNumber, startidx=0):
         ''' 
         Iterate over events quickly to find trigger.
+        Uses the trigger index if build_trigger_index was called.
         requirements = list of (branchname, value) pairs, eg. ('detector', 0)
         '''
         startidx = int(startidx)
-        for i in xrange(startidx, self.ch.GetEntries()):
-            self.ch.LoadTree(i)
-            self.branchDict['detector'].GetEntry(i)
-            if not self.branchPointers['detector'][0] == detector:
-                continue
-            self.branchDict['triggerNumber'].GetEntry(i) 
-            if not self.branchPointers['triggerNumber'][0] == triggerNumber:
-                continue
+        if self.trigger_index is not None:
+            i = self.trigger_index.find(detector, triggerNumber, startidx)
+            if i is None:
+                raise Exception('Could not find d=%d tn=%d, biggest tn is %d' % (int(detector), int(triggerNumber), self.trigger_index.max_trigger()))
             return i
-        raise Exception('Could not find d=%d tn=%d, biggest tn is %d' % (int(detector), int(triggerNumber),  self.branchPointers['triggerNumber'][0]))
+        lasttn = 0
+        for batch in self.iter_batches(10000, ['detector', 'triggerNumber'], start=startidx):
+            hits = np.flatnonzero((batch['detector'] == detector) & (batch['triggerNumber'] == triggerNumber))
+            if len(hits):
+                return int(batch.entries[hits[0]])
+            ondetector = batch['triggerNumber'][batch['detector'] == detector]
+            if len(ondetector):
+                lasttn = ondetector[-1]
+        raise Exception('Could not find d=%d tn=%d, biggest tn is %d' % (int(detector), int(triggerNumber),  lasttn))
+        return None
+
+def make_reader(tree, backend=None, cache=None):
+    '''
+    Return the reader for a RootTree. backend is 'uproot', 'pyroot' or
+    'auto', which uses uproot when it can be imported and PyROOT otherwise.
+    cache is a columncache.ColumnCache to serve decoded branches from,
+    False for none, or None for columncache.default_cache().
+    '''
+    reader = _make_backend(tree, backend)
+    if cache is None:
+        cache = columncache.default_cache()
+    if cache and os.path.isfile(tree.filename):
+        return CachedReader(tree, reader, cache)
+    return reader
+
+def _make_backend(tree, backend):
+    if backend is None:
+        backend = DEFAULT_BACKEND
+    if backend == 'auto':
+        try:
+            import uproot
+            backend = 'uproot'
+        except ImportError:
+            backend = 'pyroot'
+    if backend == 'uproot':
+        return UprootReader(tree)
+    if backend == 'pyroot':
+        return PyROOTReader(tree)
+    raise ValueError('Unknown ROOT backend %s' % backend)
+
+def vector_view(vec, dtype):
+    '''
+    numpy array over the buffer of a std::vector without copying it, or
+    None when PyROOT gives no usable buffer. The view is only valid until
+    the vector is filled again.
+    '''
+    n = vec.size()
+    if n == 0:
+        return np.zeros(0, dtype=dtype)
+    try:
+        buf = vec.data()
+        if hasattr(buf, 'SetSize'):
+            buf.SetSize(n) # ROOT 5 and old ROOT 6 buffers do not know their length
+        elif hasattr(buf, 'reshape'):
+            buf.reshape((n,)) # cppyy LowLevelView
+        return np.frombuffer(buf, dtype=dtype, count=n)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+class PyROOTReader(object):
+    '''Reads a tree entry by entry through a TChain and branch addresses.
+
+       Vector values are copied out of the branch buffers in one go (see
+       vector_view) when an Entry first asks for them. Views would not be
+       safe to hand out: the next GetEntry refills the same std::vector and
+       may reallocate its storage under any array still looking at it.
+    '''
+
+    def __init__(self, tree):
+        import ROOT
+        ch = ROOT.TChain(tree.treename)
+        status = ch.Add(tree.filename)
+        #if status == 1:
+        #    raise ValueError('Error: File %s does not have tree %s' % (filename, treename))
+        branchPointers = {}
+        branchDict = {}
+        ch.SetMakeClass(1)
+        for branchname in tree.intbranches:
+            branchPointers[branchname] = array.array('I', [0])
+        for branchname in tree.floatbranches:
+            branchPointers[branchname] = array.array('f', [0])
+        for branchname in tree.fvectorbranches:
+            branchPointers[branchname] = ROOT.std.vector('float')() 
+        for branchname in tree.ivectorbranches:
+            branchPointers[branchname] = ROOT.std.vector('int')() 
+       
+        branches = tree.branches
+        ch.SetBranchStatus("*",0)
+        [ ch.SetBranchStatus(branchname, 1) for branchname in branches ]
+        for branchname in branches:
+            branchDict[branchname] = ch.GetBranch(branchname)
+            ch.SetBranchAddress(branchname, branchPointers[branchname])
+        self.tree = tree
+        self.ch = ch
+        self.branchDict = branchDict
+        self.branchPointers = branchPointers
+
+    def num_entries(self):
+        return self.ch.GetEntries()
+
+    def load(self, i):
+        self.ch.LoadTree(i)
+        self.ch.GetEntry(i)
+
+    def vector(self, branchname, copy=False):
+        ''' Vector branch of the loaded entry in its native dtype, a view unless copy is set.'''
+        val = self.branchPointers[branchname]
+        dtype = self.tree._column_dtype(branchname)
+        view = vector_view(val, dtype)
+        if view is None:
+            return np.array(val, dtype=dtype) # Element by element through PyROOT.
+        return view.copy() if copy else view
+
+    def value(self, branchname):
+        ''' Value of a branch for the loaded entry, as an Entry holds it.'''
+        if branchname in self.tree.fvectorbranches or branchname in self.tree.ivectorbranches:
+            return self.vector(branchname, copy=True)
+        return self.branchPointers[branchname][0]
+
+    def read(self, entries, branches):
+        ''' Return {branch: column} for the given entries.'''
+        nEntries = len(entries)
+        scalars = {}
+        vectors = {}
+        for branchname in branches:
+            if branchname in self.tree.intbranches or branchname in self.tree.floatbranches:
+                scalars[branchname] = np.zeros(nEntries, dtype=self.tree._column_dtype(branchname))
+            else:
+                vectors[branchname] = []
+        treenumber = -1
+        for j, i in enumerate(entries):
+            local = self.ch.LoadTree(int(i))
+            if self.ch.GetTreeNumber() != treenumber:
+                # Branch objects belong to the current tree of the chain.
+                treenumber = self.ch.GetTreeNumber()
+                tree = self.ch.GetTree()
+                toread = [tree.GetBranch(branchname) for branchname in branches]
+            for branch in toread:
+                branch.GetEntry(local)
+            for branchname, column in scalars.iteritems():
+                column[j] = self.branchPointers[branchname][0]
+            for branchname, values in vectors.iteritems():
+                values.append(self.vector(branchname, copy=True))
+        columns = dict(scalars)
+        for branchname, values in vectors.iteritems():
+            columns[branchname] = JaggedArray.fromlist(values, dtype=self.tree._column_dtype(branchname))
+        return columns
+
+class UprootReader(object):
+    '''Reads whole baskets of a tree into numpy arrays with uproot.
+
+       Entries are read in aligned ranges of chunk_entries; the range of
+       the last entry asked for stays cached, so sequential loadentry
+       calls and nearby read_entries calls decode each basket once.
+       Works with uproot 3 (awkward 0) and uproot 4.
+    '''
+    chunk_entries = 10000
+
+    def __init__(self, tree):
+        import uproot
+        self.tree = tree
+        self.uproot3 = int(uproot.__version__.split('.')[0]) < 4
+        self.ttree = uproot.open(tree.filename)[tree.treename.strip('/')]
+        self.nentries = self.ttree.numentries if self.uproot3 else self.ttree.num_entries
+        self.chunk = None # Index of the cached range.
+        self.cache = {} # Columns of the cached range.
+        self.current = 0
+
+    def num_entries(self):
+        return self.nentries
+
+    def _branch(self, branchname):
+        # Branches may be members of a split object, as TTree::GetBranch finds them.
+        if self.uproot3:
+            return self.ttree.get(branchname, recursive=True)
+        return self.ttree[branchname]
+
+    def _read_range(self, branchname, start, stop):
+        dtype = self.tree._column_dtype(branchname)
+        if self.uproot3:
+            arr = self._branch(branchname).array(entrystart=start, entrystop=stop)
+            if branchname in self.tree.intbranches or branchname in self.tree.floatbranches:
+                return np.asarray(arr, dtype=dtype)
+            offsets = np.zeros(len(arr) + 1, dtype='int64')
+            np.cumsum(arr.counts, out=offsets[1:])
+            return JaggedArray(np.asarray(arr.content, dtype=dtype), offsets)
+        arr = self._branch(branchname).array(entry_start=start, entry_stop=stop, library='np')
+        if branchname in self.tree.intbranches or branchname in self.tree.floatbranches:
+            return np.asarray(arr, dtype=dtype)
+        return JaggedArray.fromlist(list(arr), dtype=dtype)
+
+    def _columns(self, chunk, branches):
+        if chunk != self.chunk:
+            self.chunk = chunk
+            self.cache = {}
+        start = chunk * self.chunk_entries
+        stop = min(start + self.chunk_entries, self.nentries)
+        for branchname in branches:
+            if branchname not in self.cache:
+                self.cache[branchname] = self._read_range(branchname, start, stop)
+        return self.cache
+
+    def load(self, i):
+        self.current = i
+        self._columns(i // self.chunk_entries, self.tree.branches)
+
+    def value(self, branchname):
+        ''' Value of a branch for the loaded entry, as an Entry holds it.'''
+        column = self._columns(self.current // self.chunk_entries, [branchname])[branchname]
+        local = self.current % self.chunk_entries
+        if branchname in self.tree.fvectorbranches or branchname in self.tree.ivectorbranches:
+            # the column's native dtype, as the other readers give it
+            return np.array(column[local], dtype=self.tree._column_dtype(branchname))
+        return column[local].item()
+
+    def read(self, entries, branches):
+        ''' Return {branch: column} for the given entries, reading each range once.'''
+        chunks = entries // self.chunk_entries
+        order = np.argsort(chunks, kind='mergesort')
+        pieces = dict((branchname, []) for branchname in branches)
+        bounds = np.flatnonzero(np.diff(chunks[order])) + 1
+        for group in np.split(order, bounds) if len(order) else []:
+            chunk = int(chunks[group[0]])
+            columns = self._columns(chunk, branches)
+            local = entries[group] - chunk * self.chunk_entries
+            for branchname in branches:
+                pieces[branchname].append(columns[branchname].take(local) if isinstance(columns[branchname], JaggedArray)
+                                          else columns[branchname][local])
+        # Put the rows back in the order the entries were asked for.
+        inverse = np.empty(len(entries), dtype='int64')
+        inverse[order] = np.arange(len(entries))
+        result = {}
+        for branchname in branches:
+            if branchname in self.tree.intbranches or branchname in self.tree.floatbranches:
+                column = np.concatenate(pieces[branchname]) if pieces[branchname] else np.zeros(0, dtype=self.tree._column_dtype(branchname))
+                result[branchname] = column[inverse]
+            else:
+                column = JaggedArray.concatenate(pieces[branchname]) if pieces[branchname] else JaggedArray.fromlist([], self.tree._column_dtype(branchname))
+                result[branchname] = column.take(inverse)
+        return result
+
+class CachedReader(object):
+    '''Serves branches from a columncache.ColumnCache, decoding them with reader on a miss.
+
+       The first use of a branch decodes its whole column, fill_entries at
+       a time through reader.read, together with the other branches asked
+       for at once. Later read_entries and loadentry calls, and later passes
+       of any process over the same unchanged file, slice the memory-mapped
+       columns without touching ROOT. The mappings are held until close()
+       or until the reader goes away. Values and columns handed out are
+       writable copies. If the cache cannot be written, or loses a column
+       it just stored, the reader is used directly.
+    '''
+    fill_entries = 100000
+
+    def __init__(self, tree, reader, cache):
+        self.tree = tree
+        self.reader = reader
+        self.cache = cache
+        self.columns = {} # Mapped column of each branch used so far.
+        self.current = 0
+
+    def num_entries(self):
+        return self.reader.num_entries()
+
+    def _columns(self, branches):
+        missing = [branchname for branchname in branches if branchname not in self.columns]
+        if not missing:
+            return self.columns
+        keys = dict((branchname, self.cache.key(self.tree.filename, self.tree.treename, branchname, self.tree._column_dtype(branchname)))
+                    for branchname in missing)
+        tofill = []
+        for branchname in missing:
+            stored = self.cache.get(keys[branchname])
+            if stored is None:
+                tofill.append(branchname)
+            else:
+                self.columns[branchname] = _cached_column(stored)
+        if tofill:
+            self._fill(tofill, keys)
+        return self.columns
+
+    def _fill(self, branches, keys):
+        writers = {}
+        try:
+            for branchname in branches:
+                vector = branchname in self.tree.ivectorbranches or branchname in self.tree.fvectorbranches
+                writers[branchname] = self.cache.writer(keys[branchname], self.tree._column_dtype(branchname), vector,
+                                                        {'file': os.path.abspath(self.tree.filename), 'tree': self.tree.treename, 'branch': branchname})
+            n = self.reader.num_entries()
+            for start in xrange(0, n, self.fill_entries):
+                columns = self.reader.read(np.arange(start, min(start + self.fill_entries, n)), branches)
+                for branchname, column in columns.iteritems():
+                    if isinstance(column, JaggedArray):
+                        writers[branchname].append(column.values, column.counts())
+                    else:
+                        writers[branchname].append(column)
+            stored = dict((branchname, writers.pop(branchname).commit()) for branchname in branches)
+        except (IOError, OSError), e:
+            for writer in writers.itervalues():
+                writer.abort()
+            print "Column cache %s failed (%s); reading %s directly" % (self.cache.directory, e, self.tree.filename)
+            self.cache = None
+            raise _CacheFailed()
+        except:
+            for writer in writers.itervalues():
+                writer.abort()
+            raise
+        lost = [branchname for branchname in branches if stored[branchname] is None]
+        if lost:
+            # evicted by another process between commit and lookup
+            print "Column cache %s lost %s of %s; reading it directly" % (self.cache.directory, ', '.join(lost), self.tree.filename)
+            self.cache = None
+            raise _CacheFailed()
+        for branchname in branches:
+            self.columns[branchname] = _cached_column(stored[branchname])
+        self.cache.evict(protect=set(keys.itervalues()))
+
+    def prefill(self, branches):
+        ''' Decode and store whichever of branches are not cached yet; False if the cache failed.'''
+        if self.cache is None:
+            return False
+        try:
+            self._columns(branches)
+        except _CacheFailed:
+            return False
+        return True
+
+    def close(self):
+        ''' Drop the mapped columns; values already handed out keep theirs alive.'''
+        self.columns = {}
+
+    def load(self, i):
+        self.current = i
+        if self.cache is None:
+            self.reader.load(i)
+
+    def value(self, branchname):
+        ''' Value of a branch for the loaded entry, as an Entry holds it.'''
+        if self.cache is None:
+            return self.reader.value(branchname)
+        column = self.columns.get(branchname)
+        if column is None:
+            try:
+                column = self._columns([branchname])[branchname]
+            except _CacheFailed:
+                self.reader.load(self.current)
+                return self.reader.value(branchname)
+        if isinstance(column, JaggedArray):
+            # a copy, writable like the other readers' vectors rather than a view of the read-only map
+            return np.array(column[self.current])
+        return column[self.current].item()
+
+    def read(self, entries, branches):
+        ''' Return {branch: column} for the given entries.'''
+        if self.cache is not None:
+            try:
+                columns = self._columns(branches)
+            except _CacheFailed:
+                pass
+            else:
+                return dict((branchname, columns[branchname].take(entries) if isinstance(columns[branchname], JaggedArray)
+                             else columns[branchname][entries]) for branchname in branches)
+        return self.reader.read(entries, branches)
+
+class _CacheFailed(Exception):
+    pass
+
+def _cached_column(stored):
+    values, offsets = stored
+    return values if offsets is None else JaggedArray(values, offsets)
+
+class TriggerIndex(object):
+    '''Map (detector, triggerNumber) to the entry numbers of a tree.
+
+       Keys and entries are kept sorted so a lookup is a binary search.
+    '''
+    def __init__(self, detector, triggerNumber, entries):
+        keys = _trigger_key(detector, triggerNumber)
+        entries = np.asarray(entries, dtype='int64')
+        order = np.lexsort((entries, keys))
+        self.keys = keys[order]
+        self.entries = entries[order]
+
+    @staticmethod
+    def load(filename):
+        with np.load(filename) as f:
+            index = TriggerIndex.__new__(TriggerIndex)
+            index.keys = f['keys']
+            index.entries = f['entries']
+        return index
+
+    def save(self, filename):
+        '''Write the index as .npz, renaming it into place when complete.'''
+        # array tasks on any node may build the same sidecar at once
+        tmpname = '%s.tmp-%s-%d' % (filename, socket.gethostname(), os.getpid())
+        with open(tmpname, 'wb') as f:
+            np.savez(f, keys=self.keys, entries=self.entries)
+        os.rename(tmpname, filename)
+
+    def find(self, detector, triggerNumber, startidx=0):
+        '''Return the first entry >= startidx with this trigger, or None.'''
+        key = _trigger_key(detector, triggerNumber)
+        lo = np.searchsorted(self.keys, key, side='left')
+        hi = np.searchsorted(self.keys, key, side='right')
+        pos = lo + np.searchsorted(self.entries[lo:hi], startidx)
+        if pos < hi:
+            return int(self.entries[pos])
         return None
 
-class Entry(dict):
+    def max_trigger(self):
+        if len(self.keys) == 0:
+            return 0
+        return int(np.max(self.keys & 0xffffffff))
+
+def _trigger_key(detector, triggerNumber):
+    return (np.asarray(detector, dtype='int64') << 32) | np.asarray(triggerNumber, dtype='int64')
+
+_INT, _FLOAT, _VECTOR = 0, 1, 2 # Kinds of RootTree.slots.
+
+class Entry(object):
     '''This class stores the information in a TTree entry.
 
-       NOTE: It constructs each numpy array separately in a lazy fashion so
-       they are only built if needed.
+       A read-only mapping from branch name to value. Each value is fetched
+       from the reader the first time it is asked for, into the slot
+       RootTree.slots gives it: int and float scalars in typed arrays,
+       vectors in a list. Values added with add_missing() or item assignment,
+       e.g. the stats branches of a readout entry, are kept aside and looked
+       up first. Unfetched branches can only be read until the tree loads
+       another entry. Registered as a collections.Mapping rather than
+       derived from one, since the py2.7 ABCs have no __slots__ and would
+       give every entry a __dict__.
     '''
+    __slots__ = ('parent', 'generation', 'ints', 'floats', 'vectors', 'loaded', 'extra')
+
     def __init__(self, parent_tree, lazy=True):
-        super(Entry, self).__init__(self)
         self.parent = parent_tree
-        if lazy:
-            pass
-        else:
+        self.generation = parent_tree.generation
+        self.ints = array.array('I', [0]) * len(parent_tree.intbranches)
+        self.floats = array.array('f', [0]) * len(parent_tree.floatbranches)
+        self.vectors = [None] * (len(parent_tree.ivectorbranches) + len(parent_tree.fvectorbranches))
+        self.loaded = bytearray(len(parent_tree.slots))
+        self.extra = None
+        if not lazy:
             self.unlazyconstruct()
 
     def unlazyconstruct(self):
@@ -98,35 +580,220 @@ class Entry(dict):
 
     def __getitem__(self, key):
         '''Fetch the item if it already exists, else construct it'''
-        parent = self.parent
-        if key in self:
-            return dict.__getitem__(self, key)
-        elif key in parent.intbranches:
-            val = parent.branchPointers[key][0]
-            dict.__setitem__(self, key, val)
-            return val
-        elif key in parent.floatbranches:
-            val = parent.branchPointers[key][0]
-            dict.__setitem__(self, key, val)
-            return val
-        elif key in parent.fvectorbranches:
-            val_orig = parent.branchPointers[key]
-            val = np.array(val_orig, dtype='float32')
-            dict.__setitem__(self, key, val)
-            return val
-        elif key in parent.ivectorbranches:
-            val_orig = parent.branchPointers[key]
-            val = np.array(val_orig, dtype='int')
-            dict.__setitem__(self, key, val)
-            return val
-        else:  # This will likely raise a KeyError
-            return dict.__getitem__(self, key)
-
-
-def getChargesTime(entry, preprocess_flag=True, dtype='float32'):
-    ''' This function takes a readout entry and extracts the charge and time. '''
-    charge = np.zeros((8, 24), dtype=dtype)
-    time = np.zeros((8, 24), dtype=dtype)
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        kind, j, flag = self.parent.slots[key] # KeyError for other names
+        if not self.loaded[flag]:
+            if self.generation != self.parent.generation:
+                raise RuntimeError('%s of an entry that is no longer loaded; read it before the next loadentry' % key)
+            val = self.parent.reader.value(key)
+            if kind == _INT:
+                self.ints[j] = val
+            elif kind == _FLOAT:
+                self.floats[j] = val
+            else:
+                self.vectors[j] = val
+            self.loaded[flag] = 1
+        if kind == _INT:
+            return self.ints[j]
+        if kind == _FLOAT:
+            return self.floats[j]
+        return self.vectors[j]
+
+    def __setitem__(self, key, value):
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def add_missing(self, other):
+        ''' Add the items of a mapping that this entry lacks, e.g. the stats branches of the same trigger (as iterJoinedBatches).
+            Unlike dict.update, keys this entry already has keep their values.'''
+        for key in other.keys():
+            if key not in self:
+                self[key] = other[key]
+
+    def __contains__(self, key):
+        return key in self.parent.slots or (self.extra is not None and key in self.extra)
+
+    def __iter__(self):
+        for key in self.parent.branches:
+            yield key
+        if self.extra is not None:
+            for key in self.extra:
+                if key not in self.parent.slots:
+                    yield key
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        for key in self:
+            yield self[key]
+
+    def iteritems(self):
+        for key in self:
+            yield (key, self[key])
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __repr__(self):
+        return 'Entry(%r)' % dict(self.iteritems())
+
+collections.Mapping.register(Entry)
+
+
+class JaggedArray(object):
+    '''Flat values plus offsets for a vector branch over many entries.
+
+       Entry i holds values[offsets[i]:offsets[i+1]].
+    '''
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    @staticmethod
+    def fromlist(arrays, dtype='float32'):
+        '''Build from a list of per-entry 1D arrays.'''
+        offsets = np.zeros(len(arrays) + 1, dtype='int64')
+        np.cumsum([len(a) for a in arrays], out=offsets[1:])
+        if arrays:
+            values = np.concatenate(arrays).astype(dtype, copy=False)
+        else:
+            values = np.zeros(0, dtype=dtype)
+        return JaggedArray(values, offsets)
+
+    @staticmethod
+    def concatenate(arrays):
+        '''Join several JaggedArrays end to end; ValueError for none, which gives no dtype.'''
+        arrays = list(arrays)
+        if not arrays:
+            raise ValueError('JaggedArray.concatenate needs at least one array')
+        values = np.concatenate([a.values for a in arrays])
+        counts = np.concatenate([a.counts() for a in arrays])
+        offsets = np.zeros(len(counts) + 1, dtype='int64')
+        np.cumsum(counts, out=offsets[1:])
+        return JaggedArray(values, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.values[self.offsets[i]:self.offsets[i+1]]
+
+    def counts(self):
+        return np.diff(self.offsets)
+
+    def nbytes(self):
+        return self.values.nbytes + self.offsets.nbytes
+
+    def take(self, indices):
+        '''Return a new JaggedArray with only the given entries, in that order.'''
+        indices = np.asarray(indices, dtype='int64')
+        starts = self.offsets[:-1][indices]
+        counts = self.offsets[1:][indices] - starts
+        offsets = np.zeros(len(indices) + 1, dtype='int64')
+        np.cumsum(counts, out=offsets[1:])
+        # Position of every kept value in the original flat array.
+        flat = np.repeat(starts - offsets[:-1], counts) + np.arange(offsets[-1])
+        return JaggedArray(self.values[flat], offsets)
+
+
+class Batch(object):
+    '''Columns for a set of entries of a RootTree.
+
+       batch[branchname] is a numpy array for scalar branches and a
+       JaggedArray for vector branches. batch.entries holds the entry numbers.
+    '''
+    def __init__(self, columns, entries):
+        self.columns = columns
+        self.entries = entries
+
+    @staticmethod
+    def concatenate(batches):
+        '''Join several Batches with the same branches end to end; ValueError for none, which gives no branches.'''
+        batches = list(batches)
+        if not batches:
+            raise ValueError('Batch.concatenate needs at least one batch')
+        columns = {}
+        for key, column in batches[0].columns.iteritems():
+            if isinstance(column, JaggedArray):
+                columns[key] = JaggedArray.concatenate([b[key] for b in batches])
+            else:
+                columns[key] = np.concatenate([b[key] for b in batches])
+        entries = np.concatenate([b.entries for b in batches])
+        return Batch(columns, entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, key):
+        return self.columns[key]
+
+    def __contains__(self, key):
+        return key in self.columns
+
+    def keys(self):
+        return self.columns.keys()
+
+    def nbytes(self):
+        '''Bytes held by the decoded columns.'''
+        return sum(column.nbytes() if isinstance(column, JaggedArray) else column.nbytes
+                   for column in self.columns.itervalues())
+
+    def take(self, indices):
+        '''Return a new Batch with only the given rows, in that order.'''
+        indices = np.asarray(indices, dtype='int64')
+        columns = dict((key, column.take(indices)) for key, column in self.columns.iteritems())
+        return Batch(columns, self.entries[indices])
+
+    def row(self, i):
+        return BatchRow(self, i)
+
+
+class BatchRow(object):
+    '''Read-only view of one row of a Batch that can stand in for an Entry.'''
+    __slots__ = ('batch', 'index')
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+    def __getitem__(self, key):
+        return self.batch.columns[key][self.index]
+
+    def __contains__(self, key):
+        return key in self.batch.columns
+
+
+def getChargesTime(entry, preprocess_flag=True, dtype='float32', out=None):
+    '''
+    This function takes a readout entry and extracts the charge and time.
+    out is an optional (charge, time) pair of (8, 24) arrays to fill
+    instead of new ones.
+    '''
+    if out is None:
+        charge = np.zeros((8, 24), dtype=dtype)
+        time = np.zeros((8, 24), dtype=dtype)
+    else:
+        charge, time = out
+        charge.fill(0)
+        time.fill(0)
     nHitsAD = entry['nHitsAD']
     chargeAD = entry['chargeAD']
     timeAD = entry['timeAD']
@@ -150,15 +817,85 @@ def getChargesTime(entry, preprocess_flag=True, dtype='float32'):
         charge[ring[hit], column[hit]] = chargeAD[hit]
         time[ring[hit], column[hit]] = timeAD[hit]
     if preprocess_flag:
-        charge = preprocess(charge)
+        charge = preprocess(charge, out=charge)
     return charge, time
 
-def preprocess(X):
-    ''' Preprocess charge image by taking log and dividing by scale factor.'''
+def getChargesTimeBatch(batch, preprocess_flag=True, dtype='float32', out=None):
+    '''
+    Vectorized getChargesTime for every entry of a Batch (or a dict of
+    nHitsAD, chargeAD, timeAD, ring and column columns). Returns (N, 8, 24)
+    charge and time arrays. Duplicate hits on a PMT are resolved exactly as
+    getChargesTime does for float32 and float64 output. out is an optional
+    (charge, time) pair of C-contiguous arrays of at least N rows, reused
+    between batches; the first N rows are filled and returned.
+    '''
+    chargeAD = batch['chargeAD']
+    nEvents = len(chargeAD)
+    if out is None:
+        charge = np.zeros(nEvents * 8 * 24, dtype=dtype)
+        time = np.zeros(nEvents * 8 * 24, dtype=dtype)
+    else:
+        charge = out[0][:nEvents].reshape(-1)
+        time = out[1][:nEvents].reshape(-1)
+        charge.fill(0)
+        time.fill(0)
+    # Only the first nHitsAD hits of each event are used.
+    counts = chargeAD.counts()
+    event = np.repeat(np.arange(nEvents), counts)
+    hitnum = np.arange(len(event)) - np.repeat(chargeAD.offsets[:-1], counts)
+    hits = np.nonzero(hitnum < np.asarray(batch['nHitsAD'])[event])[0]
+    ring = batch['ring'].values[hits].astype('int64') - 1 # Convert to 0-idx
+    column = batch['column'].values[hits].astype('int64') - 1
+    if np.any((ring < -8) | (ring >= 8) | (column < -24) | (column >= 24)):
+        raise IndexError('PMT ring/column out of range')
+    # Negative indices wrap around, like numpy indexing in getChargesTime.
+    pixel = event[hits] * 192 + (ring % 8) * 24 + column % 24
+    chargeHits = chargeAD.values[hits]
+    timeHits = batch['timeAD'].values[hits]
+    in_window = (timeHits > -1650) & (timeHits < -1250)
+
+    # A later hit only replaces the kept one if it is in the window and the
+    # kept one is not or is later. So the kept hit is the earliest in-window
+    # hit (first one on ties), or else the first hit.
+    # lexsort is stable, so ties stay in hit order.
+    order = np.lexsort((np.where(in_window, timeHits, 0), pixel * 2 + ~in_window))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = pixel[order[1:]] != pixel[order[:-1]]
+    keep = order[first]
+    # A kept hit with zero charge looks like an empty PMT to getChargesTime
+    # and is overwritten by the next hit, so replay those PMTs hit by hit.
+    replay = np.in1d(pixel, pixel[chargeHits == 0])
+    keep = keep[~replay[keep]]
+    charge[pixel[keep]] = chargeHits[keep]
+    time[pixel[keep]] = timeHits[keep]
+    for hit in np.nonzero(replay)[0]:
+        p = pixel[hit]
+        if charge[p] != 0.0:
+            time_orig = time[p]
+            time_new = timeHits[hit]
+            orig_in_window = (time_orig > -1650) and (time_orig < -1250)
+            if not (in_window[hit] and (not orig_in_window or time_new < time_orig)):
+                continue
+        charge[p] = chargeHits[hit]
+        time[p] = timeHits[hit]
+
+    charge = charge.reshape((nEvents, 8, 24))
+    time = time.reshape((nEvents, 8, 24))
+    if preprocess_flag:
+        charge = preprocess(charge, out=None if out is None else charge)
+    return charge, time
+
+def preprocess(X, out=None):
+    '''
+    Preprocess charge image by taking log and dividing by scale factor.
+    With out (which may be X itself) the result is written there.
+    '''
     prelog = 1.0
     scale = 10.0 # log(500000) ~= 10
-    X = np.maximum(X, np.zeros_like(X))
-    X = np.log(X + prelog) / scale
+    X = np.maximum(X, 0, out=out)
+    X += prelog
+    np.log(X, out=X)
+    X /= scale
     return X
 
 def isflasher(entry):
@@ -181,6 +918,25 @@ def ismuon(entry):
     NominalCharge = entry['NominalCharge']
     return NominalCharge > 3000.0    
 
+def isflasher_array(stats):
+    ''' Vectorized isflasher over columns (e.g. a Batch) of CalibStats variables.'''
+    # The per-entry cut sees python floats, so compute in float64 as well.
+    MaxQ = np.asarray(stats['MaxQ'], dtype='float64')
+    Quadrant = np.asarray(stats['Quadrant'], dtype='float64')
+    time_PSD = np.asarray(stats['time_PSD'], dtype='float64')
+    time_PSD1 = np.asarray(stats['time_PSD1'], dtype='float64')
+    MaxQ_2inchPMT = np.asarray(stats['MaxQ_2inchPMT'], dtype='float64')
+    NominalCharge = np.asarray(stats['NominalCharge'], dtype='float64')
+    eps = 10**-10
+    flasher = ~((np.log10(Quadrant**2 + MaxQ**2/0.45/0.45 + eps) < 0.0) & \
+                (np.log10(4.0 * (1.0-time_PSD)**2 + 1.8 * (1.0-time_PSD1)**2 + eps) < 0.0) & \
+                (MaxQ_2inchPMT < 100.0)) & (NominalCharge <= 3000.0)
+    return flasher
+
+def ismuon_array(stats):
+    ''' Vectorized ismuon over a column of NominalCharge. '''
+    return np.asarray(stats['NominalCharge'], dtype='float64') > 3000.0
+
 def get_num_entries(filename):
     return get_num_readout_entries(filename)
 
@@ -211,12 +967,64 @@ def makeCalibStatsTree(filename):
     return t2
     
 
+def match_triggers(left, right):
+    '''
+    Match two columns of trigger numbers using sorted arrays.
+    Like filling a dict from left and updating it from right, the last
+    occurrence of a trigger number on either side wins. Returns the index
+    arrays (left_idx, right_idx) of the matched pairs, ordered by left_idx.
+    '''
+    left_values, left_idx = _last_occurrences(np.asarray(left))
+    right_values, right_idx = _last_occurrences(np.asarray(right))
+    pos = np.searchsorted(left_values, right_values)
+    found = pos < len(left_values)
+    found[found] = left_values[pos[found]] == right_values[found]
+    left_idx = left_idx[pos[found]]
+    right_idx = right_idx[found]
+    order = np.argsort(left_idx)
+    return left_idx[order], right_idx[order]
+
+def _last_occurrences(values):
+    '''Return the sorted unique values and the index of their last occurrence.'''
+    order = np.argsort(values, kind='mergesort') # Stable, so the last duplicate comes last.
+    values = values[order]
+    last = np.ones(len(values), dtype=bool)
+    last[:-1] = values[1:] != values[:-1]
+    return values[last], order[last]
+
+def joinCalibTrees(t1, t2, detectors=[0,1,2,3,4]):
+    '''
+    Match CalibReadout entries of the given detectors (t1) with CalibStats
+    entries (t2) by triggerNumber. Only the key columns are read. Returns
+    the entry numbers (readout_entries, stats_entries) of the matched pairs
+    in readout order; readout triggers without stats are dropped.
+    '''
+    readout = t1.read_columns(['triggerNumber', 'detector'])
+    readout = readout.take(np.nonzero(np.in1d(readout['detector'], detectors))[0])
+    stats = t2.read_columns(['triggerNumber'])
+    readout_idx, stats_idx = match_triggers(readout['triggerNumber'], stats['triggerNumber'])
+    return readout.entries[readout_idx], stats.entries[stats_idx]
+
+def iterJoinedBatches(t1, t2, readout_entries, stats_entries, readout_branches, stats_branches, batch_size=10000):
+    '''
+    Return generator of Batches holding the readout_branches of t1 and the
+    stats_branches of t2 for matched entries, as from joinCalibTrees.
+    '''
+    for start in xrange(0, len(readout_entries), batch_size):
+        stop = min(start + batch_size, len(readout_entries))
+        batch = t1.read_entries(readout_entries[start:stop], readout_branches)
+        stats = t2.read_entries(stats_entries[start:stop], stats_branches)
+        for branchname in stats.keys():
+            if branchname not in batch:
+                batch.columns[branchname] = stats[branchname]
+        yield batch
+
 def rootfileiter(filename):
     t2 = makeCalibStatsTree(filename)
     t1 = makeCalibReadoutTree(filename)
 
     for entry1, entry2 in itertools.izip(t1.getentries(), t2.getentries()):
-        entry1.update(entry2)
+        entry1.add_missing(entry2)
         yield entry1
 
 def calibReadoutIter(filename):
@@ -0,0 +1,95 @@
+# Class-balanced reservoir sampling of training examples from a stream of batches
+import os
+import numpy as np
+
+class ClassReservoir(object):
+    '''Uniform random sample of at most capacity rows per class of a stream.
+
+       columns maps a name to (row shape, dtype) like H5StreamWriter. Every
+       add() offers a batch of rows with their labels; each class keeps a
+       fixed buffer of capacity rows, filled first and then replaced with
+       Algorithm R, so memory does not grow with the stream and every row
+       seen of a class is equally likely to be kept.
+    '''
+    def __init__(self, classes, capacity, columns, seed=None):
+        self.classes = list(classes)
+        self.capacity = capacity
+        self.rng = np.random.RandomState(seed)
+        self.seen = dict((label, 0) for label in self.classes)
+        self.buffers = dict((label, dict((name, np.zeros((capacity,) + tuple(shape), dtype=dtype))
+                                         for name, (shape, dtype) in columns.iteritems()))
+                            for label in self.classes)
+
+    def held(self, label):
+        return min(self.seen[label], self.capacity)
+
+    def full(self):
+        return all(self.seen[label] >= self.capacity for label in self.classes)
+
+    def nbytes(self):
+        return sum(buf.nbytes for bufs in self.buffers.itervalues() for buf in bufs.itervalues())
+
+    def add(self, labels, rows):
+        '''Offer a dict of arrays with one row per entry of labels; labels outside classes are ignored.'''
+        labels = np.asarray(labels)
+        for label in self.classes:
+            sel = np.flatnonzero(labels == label)
+            if len(sel) == 0:
+                continue
+            bufs = self.buffers[label]
+            seen = self.seen[label]
+            # rows that still fit go to the next free slots
+            nfill = max(0, min(len(sel), self.capacity - seen))
+            for name, buf in bufs.iteritems():
+                buf[seen:seen+nfill] = np.asarray(rows[name])[sel[:nfill]]
+            # the k-th row of the class replaces a random slot with probability capacity/k
+            rest = sel[nfill:]
+            if len(rest):
+                position = seen + nfill + np.arange(1, len(rest) + 1)
+                slot = (self.rng.random_sample(len(rest)) * position).astype('int64')
+                keep = slot < self.capacity
+                # numpy assigns repeated slots in order, so the latest row wins as in the sequential algorithm
+                for name, buf in bufs.iteritems():
+                    buf[slot[keep]] = np.asarray(rows[name])[rest[keep]]
+            self.seen[label] = seen + len(sel)
+
+    def balanced(self, n=None):
+        '''
+        Return (labels, rows) with n rows of every class (default: as many as
+        the scarcest class holds), shuffled together.
+        '''
+        if n is None:
+            n = min(self.held(label) for label in self.classes)
+        n = min([n] + [self.held(label) for label in self.classes])
+        labels = np.repeat(self.classes, n)
+        order = self.rng.permutation(len(labels))
+        # the first slots of a replaced reservoir favour early rows, so take a random n of those held
+        keep = dict((label, np.sort(self.rng.choice(self.held(label), n, replace=False))) for label in self.classes)
+        rows = {}
+        for name in self.buffers[self.classes[0]]:
+            column = np.concatenate([self.buffers[label][name][keep[label]] for label in self.classes])
+            rows[name] = column[order]
+        return labels[order], rows
+
+def capacity_for(budget_bytes, columns, nclasses):
+    ''' Rows per class that fit the reservoirs of nclasses classes into budget_bytes.'''
+    row_bytes = sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for shape, dtype in columns.itervalues())
+    return int(budget_bytes // (row_bytes * nclasses))
+
+def write_shards(prefix, rows, shard_rows):
+    '''
+    Write a dict of equal length arrays to prefix_000.h5, prefix_001.h5, ...
+    of at most shard_rows rows each, every one renamed into place when
+    complete. Returns the file names.
+    '''
+    import h5py
+    n = len(rows.itervalues().next())
+    filenames = []
+    for i, start in enumerate(xrange(0, max(n, 1), shard_rows)):
+        filename = '%s_%03d.h5' % (prefix, i)
+        with h5py.File(filename + '.tmp', 'w') as h5f:
+            for name, column in rows.iteritems():
+                h5f.create_dataset(name, data=column[start:start+shard_rows])
+        os.rename(filename + '.tmp', filename)
+        filenames.append(filename)
+    return filenames
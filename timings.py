@@ -0,0 +1,193 @@
+# Per-stage timing, throughput and memory records for the converters
+import os
+import json
+import time
+import socket
+import resource
+
+class StageTimings(object):
+    '''Time, events and bytes per converter stage, per input file.
+
+       bytes_decoded counts the numpy arrays the ROOT branches were decoded
+       into, not bytes read from disk; bytes_written counts the output file.
+
+       Wrap each stage with `with timings.stage('read', events=n):` or add
+       measured values with add(). Stages of the current file are
+       accumulated between begin_file() and end_file(), which also records
+       the wall time and the peak RSS of this process and its children.
+       Peak RSS is also sampled at every stage boundary; each stage records
+       by how much it rose since the previous boundary (rss_growth_mb), so
+       the stage that allocates shows up even though the peak never falls.
+       With stages on several threads the growth is only approximately
+       attributed.
+    '''
+    def __init__(self, rank):
+        self.rank = rank
+        self.host = socket.gethostname()
+        self.files = []
+        self.earlier = None # records of earlier runs already in this rank's file, read by the first save()
+        self.current = None
+
+    def begin_file(self, input_file):
+        self.current = {'input': input_file, 'stages': {}, 'start': time.time()}
+        self.last_rss_mb = peak_rss_mb()
+
+    def rss_growth(self):
+        ''' MB the peak RSS rose since the previous stage boundary, which this call becomes.'''
+        rss = peak_rss_mb()
+        growth = rss - self.last_rss_mb
+        self.last_rss_mb = rss
+        return growth
+
+    def add(self, name, seconds, events=0, bytes_decoded=0, bytes_written=0, rss_growth_mb=None):
+        '''
+        Add a stage that just ended; its RSS growth is taken since the previous
+        stage boundary unless given, as for stages of another process.
+        '''
+        if rss_growth_mb is None:
+            rss_growth_mb = self.rss_growth()
+        stage = self.current['stages'].setdefault(name, {'seconds': 0.0, 'events': 0, 'bytes_decoded': 0, 'bytes_written': 0, 'rss_growth_mb': 0.0})
+        stage['seconds'] += seconds
+        stage['events'] += int(events)
+        stage['bytes_decoded'] += int(bytes_decoded)
+        stage['bytes_written'] += int(bytes_written)
+        stage['rss_growth_mb'] += rss_growth_mb
+
+    def merge(self, stages):
+        ''' Add the stages dict of another StageTimings file record, e.g. from a worker process.'''
+        for name, stage in stages.iteritems():
+            self.add(name, stage['seconds'], stage['events'], stage['bytes_decoded'], stage['bytes_written'], stage['rss_growth_mb'])
+
+    def add_queues(self, report):
+        ''' Add a pipeline.Pipeline report (busy, starved and blocked seconds, queue depths per stage).'''
+        queues = self.current.setdefault('queues', {})
+        for name, stage in report.iteritems():
+            total = queues.setdefault(name, {'items': 0, 'busy': 0.0, 'starved': 0.0, 'blocked': 0.0, 'depth_sum': 0.0, 'max_depth': 0})
+            total['items'] += stage['items']
+            total['busy'] += stage['busy']
+            total['starved'] += stage['starved']
+            total['blocked'] += stage['blocked']
+            total['depth_sum'] += stage['mean_depth'] * stage['items']
+            total['max_depth'] = max(total['max_depth'], stage['max_depth'])
+
+    def stage(self, name, events=0, bytes_decoded=0, bytes_written=0):
+        return _StageContext(self, name, events, bytes_decoded, bytes_written)
+
+    def end_file(self, status='done'):
+        rec = self.current
+        rec['status'] = status
+        rec['seconds'] = time.time() - rec.pop('start')
+        rec['peak_rss_mb'] = peak_rss_mb()
+        self.files.append(rec)
+        self.current = None
+        return rec
+
+    def save(self, directory):
+        '''
+        Write this rank's records to directory/rank-<rank>.json, after the
+        records an earlier run (e.g. before a --resume) left there.
+        '''
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        filename = os.path.join(directory, 'rank-%05d.json' % self.rank)
+        if self.earlier is None:
+            self.earlier = []
+            if os.path.exists(filename):
+                with open(filename) as f:
+                    self.earlier = json.load(f)['files']
+        with open(filename + '.tmp', 'w') as f:
+            json.dump({'rank': self.rank, 'host': self.host, 'files': self.earlier + self.files}, f, indent=1, sort_keys=True)
+        os.rename(filename + '.tmp', filename)
+
+class _StageContext(object):
+    def __init__(self, timings, name, events, bytes_decoded, bytes_written):
+        self.timings = timings
+        self.args = (name, events, bytes_decoded, bytes_written)
+
+    def __enter__(self):
+        self.timings.rss_growth() # growth before the stage is not the stage's
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        name, events, bytes_decoded, bytes_written = self.args
+        self.timings.add(name, time.time() - self.t0, events, bytes_decoded, bytes_written)
+        return False
+
+def peak_rss_mb():
+    ''' Peak resident set size in MB of this process and of its largest child.'''
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024. # ru_maxrss is in kB on Linux
+
+def load(directory):
+    ''' Return the records of every rank-*.json in directory, ordered by rank.'''
+    import glob
+    ranks = []
+    for filename in glob.glob(os.path.join(directory, 'rank-*.json')):
+        with open(filename) as f:
+            ranks.append(json.load(f))
+    return sorted(ranks, key=lambda r: r['rank'])
+
+def report(ranks):
+    '''
+    Merge per-rank records into one dict with totals per stage and per
+    rank. Events per second of a stage are its events over its summed time.
+    '''
+    stages = {}
+    queues = {}
+    per_rank = []
+    for r in ranks:
+        seconds = sum(f['seconds'] for f in r['files'])
+        per_rank.append({'rank': r['rank'], 'host': r['host'], 'files': len(r['files']), 'seconds': seconds,
+                         'peak_rss_mb': max([f['peak_rss_mb'] for f in r['files']] or [0])})
+        for f in r['files']:
+            for name, stage in f['stages'].iteritems():
+                total = stages.setdefault(name, {'seconds': 0.0, 'events': 0, 'bytes_decoded': 0, 'bytes_written': 0, 'rss_growth_mb': 0.0})
+                for key in total:
+                    total[key] += stage.get(key, 0) # records written before rss_growth_mb or bytes_decoded have none
+            for name, stage in f.get('queues', {}).iteritems():
+                total = queues.setdefault(name, {'items': 0, 'busy': 0.0, 'starved': 0.0, 'blocked': 0.0, 'depth_sum': 0.0, 'max_depth': 0})
+                for key in ('items', 'busy', 'starved', 'blocked', 'depth_sum'):
+                    total[key] += stage[key]
+                total['max_depth'] = max(total['max_depth'], stage['max_depth'])
+    for total in stages.itervalues():
+        total['events_per_second'] = total['events'] / total['seconds'] if total['seconds'] > 0 else 0.
+    for total in queues.itervalues():
+        total['mean_depth'] = total.pop('depth_sum') / total['items'] if total['items'] else 0.
+        # share of the time the stage was not waiting on its neighbours
+        waited = total['busy'] + total['starved'] + total['blocked']
+        total['utilization'] = total['busy'] / waited if waited > 0 else 0.
+    return {'stages': stages, 'queues': queues, 'ranks': per_rank,
+            'files': sum(p['files'] for p in per_rank),
+            'seconds': sum(p['seconds'] for p in per_rank)}
+
+def print_report(rep):
+    print "%d files, %.1f rank-seconds" % (rep['files'], rep['seconds'])
+    stage_seconds = sum(s['seconds'] for s in rep['stages'].itervalues()) or 1.
+    print "%-10s %10s %7s %12s %12s %10s %10s %10s" % ('stage', 'seconds', 'share', 'events', 'events/s', 'MB decoded', 'MB written', 'RSS +MB')
+    for name, s in sorted(rep['stages'].iteritems(), key=lambda kv: -kv[1]['seconds']):
+        print "%-10s %10.1f %6.1f%% %12d %12.0f %10.1f %10.1f %10.1f" % (name, s['seconds'], 100 * s['seconds'] / stage_seconds,
+              s['events'], s['events_per_second'], s['bytes_decoded'] / 1e6, s['bytes_written'] / 1e6, s['rss_growth_mb'])
+    if rep.get('queues'):
+        import pipeline
+        print "pipelined stages (starved: waiting for input, blocked: waiting for the next stage)"
+        pipeline.print_report(rep['queues'])
+    if rep['ranks']:
+        busiest = max(rep['ranks'], key=lambda p: p['seconds'])
+        laziest = min(rep['ranks'], key=lambda p: p['seconds'])
+        print "rank seconds: max %.1f (rank %d), min %.1f (rank %d); peak RSS max %.0f MB" % (
+            busiest['seconds'], busiest['rank'], laziest['seconds'], laziest['rank'],
+            max(p['peak_rss_mb'] for p in rep['ranks']))
+
+if __name__ == '__main__':
+    # Merge the per-rank records of a job: python timings.py <directory> [report.json]
+    import sys
+    rep = report(load(sys.argv[1]))
+    print_report(rep)
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], 'w') as f:
+            json.dump(rep, f, indent=1, sort_keys=True)
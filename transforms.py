@@ -0,0 +1,118 @@
+# In-place feature transforms on (N, 8, 24) batches of AD charge and time images
+import numpy as np
+
+NRINGS = 8
+NCOLUMNS = 24
+TRIGGER_WINDOW = (-1650., -1250.) # Hit times (ns) getChargesTime prefers when a PMT has two hits.
+GEOMETRY_DTYPE = [('ring', 'int32'), ('column', 'int32'), ('index', 'int32'), ('phi', 'float32')]
+
+def pmt_geometry():
+    '''
+    The AD PMT grid in image order: ring and column numbered from 1 as in
+    the ROOT branches, the flat index into an 8x24 image and the azimuth
+    of the column in degrees (24 columns, 15 degrees apart).
+    '''
+    ring, column = np.mgrid[1:NRINGS+1, 1:NCOLUMNS+1]
+    geometry = np.zeros(NRINGS * NCOLUMNS, dtype=GEOMETRY_DTYPE)
+    geometry['ring'] = ring.ravel()
+    geometry['column'] = column.ravel()
+    geometry['index'] = np.arange(NRINGS * NCOLUMNS)
+    geometry['phi'] = (column.ravel() - 1) * 360. / NCOLUMNS
+    return geometry
+
+GEOMETRY = pmt_geometry()
+
+class LogScale(object):
+    '''charge -> log(max(charge, 0) + prelog) / scale, as roottools.preprocess.'''
+    def __init__(self, prelog=1.0, scale=10.0):
+        self.prelog = prelog
+        self.scale = scale
+
+    def __call__(self, charge, time):
+        np.maximum(charge, 0, out=charge)
+        charge += self.prelog
+        np.log(charge, out=charge)
+        charge /= self.scale
+
+class TimeWindow(object):
+    '''
+    time -> (time - lo) / (hi - lo), so hits inside the trigger window fall
+    in [0, 1]. PMTs without a hit (charge 0, also after LogScale) keep 0.
+    '''
+    def __init__(self, window=TRIGGER_WINDOW):
+        self.lo, self.hi = window
+        self.empty = np.zeros(0, dtype=bool) # Reused mask of PMTs without a hit.
+
+    def __call__(self, charge, time):
+        if self.empty.size < charge.size:
+            self.empty = np.zeros(charge.size, dtype=bool)
+        empty = self.empty[:charge.size].reshape(charge.shape)
+        np.equal(charge, 0, out=empty)
+        time -= self.lo
+        time *= 1. / (self.hi - self.lo)
+        np.copyto(time, 0, where=empty)
+
+class CylinderPad(object):
+    '''
+    Unroll the AD cylinder with pad columns of wrap-around on each side, so
+    the last column sits next to the first: images become (N, 8, 24 + 2 pad).
+    The gather indices come from GEOMETRY once.
+    '''
+    def __init__(self, pad=1, geometry=GEOMETRY):
+        self.pad = pad
+        grid = np.zeros((NRINGS, NCOLUMNS), dtype='int64')
+        grid[geometry['ring'] - 1, geometry['column'] - 1] = geometry['index']
+        self.index = grid[:, np.arange(-pad, NCOLUMNS + pad) % NCOLUMNS].ravel()
+
+    def shape(self):
+        return (NRINGS, NCOLUMNS + 2 * self.pad)
+
+    def __call__(self, image, out):
+        n = len(image)
+        np.take(image.reshape((n, -1)), self.index, axis=1, out=out.reshape((n, -1)))
+
+class FeatureStage(object):
+    '''Turn charge and time image batches into feature rows with no per-batch allocation.
+
+       transforms are applied in order, in place, to the (N, 8, 24) charge
+       and time images (see LogScale and TimeWindow); an optional
+       CylinderPad then unrolls both. Rows are charge then time, flattened,
+       as hstack((charge, time)) of getChargesTime. Buffers grow to the
+       largest batch and are reused, so images() and the rows returned are
+       only valid until the next call.
+    '''
+    def __init__(self, transforms=(), pad=None, dtype='float32'):
+        self.transforms = list(transforms)
+        self.pad = pad
+        self.dtype = np.dtype(dtype)
+        self.capacity = 0
+        self.nfeatures = 2 * int(np.prod(pad.shape() if pad is not None else (NRINGS, NCOLUMNS)))
+
+    def _grow(self, n):
+        if n <= self.capacity:
+            return
+        self.capacity = n
+        self.charge = np.zeros((n, NRINGS, NCOLUMNS), dtype=self.dtype)
+        self.time = np.zeros((n, NRINGS, NCOLUMNS), dtype=self.dtype)
+        self.rows = np.zeros((n, self.nfeatures), dtype=self.dtype)
+
+    def images(self, n):
+        ''' (charge, time) buffers of n images, e.g. the out= of roottools.getChargesTimeBatch.'''
+        self._grow(n)
+        return self.charge[:n], self.time[:n]
+
+    def __call__(self, charge, time):
+        '''Return (n, nfeatures) rows; charge and time are overwritten unless they are copied into images() first.'''
+        n = len(charge)
+        self._grow(n)
+        for transform in self.transforms:
+            transform(charge, time)
+        rows = self.rows[:n]
+        half = self.nfeatures // 2
+        if self.pad is not None:
+            self.pad(charge, rows[:, :half])
+            self.pad(time, rows[:, half:])
+        else:
+            rows[:, :half] = charge.reshape((n, half))
+            rows[:, half:] = time.reshape((n, half))
+        return rows